@@ -4,6 +4,9 @@ from typing import Union
 
 from orjson import orjson
 
+# Speed can be 60 km/h up to distances of 3km
+QUEST_WALK_SPEED_CALCULATED = 16.67
+
 @dataclasses.dataclass(frozen=True, eq=True)
 class Location:
     lat: float
@@ -13,6 +13,27 @@ parser.add_argument('-vv', '--trace', action='store_true')
 
 logger = logging.getLogger(__name__)
 
+
+def _parse_hosts(value: str, default_port: int) -> list[tuple[str, int]]:
+    # "host1:port1, host2"
+    hosts = []
+    for entry in (value or "").split(","):
+        if entry.strip():
+            host, _, port = entry.strip().partition(":")
+            hosts.append((host, int(port) if port else default_port))
+    return hosts
+
+
+def _parse_mapping(value: str, value_type=str) -> dict:
+    # "key1:value1, key2:value2"
+    result = {}
+    for entry in (value or "").split(","):
+        if ":" in entry:
+            key, val = entry.split(":", 1)
+            result[key.strip()] = value_type(val.strip())
+    return result
+
+
 class Config:
     general = config["general"]
     listen_host = general.get("listen_host", "127.0.0.1")
@@ -26,8 +47,33 @@ class Config:
     encounter_limit = general.getint("encounter_limit", 6500)
     device_max_logins_hour = general.getint("device_max_logins_per_hour", 4)
     account_max_logins_hour = general.getint("account_max_logins_per_hour", 4)
+    availability_cache_seconds = general.getint("availability_cache_ms", 500) / 1000
+    request_deadline_seconds = general.getint("request_deadline_ms", 10000) / 1000
+    etag_max_age_seconds = general.getint("etag_max_age", 60)
+    compress_min_bytes = general.getint("compress_min_bytes", 2048)
+    export_batch_size = general.getint("export_batch_size", 5000)
+    rollup_interval_seconds = general.getint("rollup_interval", 300)
+    purpose_weights = _parse_mapping(general.get("purpose_weights", ""), float)
+    region_quotas = _parse_mapping(general.get("region_quotas", ""), int)
+    scheduler_window = general.getint("scheduler_window", 2)
+    forecast_resync_seconds = general.getint("forecast_resync", 1800)
+    snapshot_file = general.get("snapshot_file", "")
+    snapshot_interval_seconds = general.getint("snapshot_interval", 300)
+    encounter_aware_purposes = [purpose.strip() for purpose in general.get("encounter_aware_purposes", "").split(",") if purpose.strip()]
+    demand_refresh_seconds = general.getint("demand_refresh", 3600)
+    idempotency_ttl_seconds = general.getint("idempotency_ttl", 300)
+    idempotency_max_entries = general.getint("idempotency_max_entries", 10000)
+    health_bucket = general.getint("health_bucket", 25)
+    reconcile_interval_seconds = general.getint("reconcile_interval", 600)
+    reconcile_batch_size = general.getint("reconcile_batch_size", 200)
+    reconcile_duty_cycle = general.getfloat("reconcile_duty_cycle", 0.1)
+    slow_request_seconds = general.getint("slow_request_ms", 1000) / 1000
+    log_json = general.getboolean("log_json", False)
+    log_sample_rate = general.getfloat("log_sample_rate", 1.0)
+    log_rate_limit = general.getfloat("log_rate_limit", 0.0)
 
-    args = parser.parse_args()
+    # tolerate the arguments of other entry points importing the config, like simulator.py
+    args, _ = parser.parse_known_args()
     if args.verbose:
         loglevel = logging.DEBUG
     elif args.trace:
@@ -41,6 +87,15 @@ class Config:
     db_user = database.get("user", None)
     db_pw = database.get("pass", None)
     db = database.get("db", None)
+    db_flavor = database.get("flavor", "mysql").lower()
+    db_circuit_failure_threshold = database.getint("circuit_failure_threshold", 5)
+    db_circuit_reset_seconds = database.getint("circuit_reset_seconds", 10)
+    db_replicas = _parse_hosts(database.get("replicas", ""), db_port)
+    db_replica_max_lag_seconds = database.getfloat("replica_max_lag", 5)
+    db_replica_stand_in = database.getboolean("replica_stand_in", False)
+    db_read_your_writes_seconds = database.getfloat("read_your_writes", 10)
+    db_inject_latency_ms = database.getint("inject_latency_ms", 0)
+    db_inject_latency_jitter_ms = database.getint("inject_latency_jitter_ms", 0)
 
     def __init__(self):
         if self.db_user is None or self.db_pw is None or self.db is None or self.auth_username is None \
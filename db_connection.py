@@ -1,6 +1,246 @@
+import collections
+import itertools
+import math
+import random
+import re
+import threading
+import time
+from typing import Optional
+
 import mysql.connector
+from loguru import logger
+
+import profiling
 from config import Config
 
+# errors that indicate a slow or unreachable database rather than a broken query
+# 1205: lock wait timeout, 2006: server gone away, 2013: lost connection,
+# 3024: MAX_EXECUTION_TIME exceeded, 1969: max_statement_time exceeded (MariaDB)
+_UNHEALTHY_ERRNOS = {1205, 2006, 2013, 3024, 1969}
+_TIMEOUT_ERRNOS = {1205, 3024, 1969}
+
+_WRITE_STATEMENT = re.compile(r"\s*(INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+
+_deadline = threading.local()
+
+
+def set_deadline(seconds: Optional[float]):
+    _deadline.at = time.monotonic() + seconds if seconds else None
+
+
+def clear_deadline():
+    _deadline.at = None
+
+
+def deadline_remaining() -> Optional[float]:
+    at = getattr(_deadline, "at", None)
+    if at is None:
+        return None
+    return at - time.monotonic()
+
+
+def set_request_device(device: Optional[str]):
+    """Device of the current request, its writes pin its reads to the primary for a while (read-your-writes)."""
+    _deadline.device = device or None
+
+
+def request_device() -> Optional[str]:
+    return getattr(_deadline, "device", None)
+
+
+class DatabaseUnavailable(Exception):
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(DatabaseUnavailable):
+    pass
+
+
+class InjectedTimeout(mysql.connector.errors.OperationalError):
+    def __init__(self, msg: str):
+        super().__init__(msg=msg, errno=3024)
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` failures within `window_seconds` and rejects calls for `reset_seconds`.
+
+    Successes in between don't reset the count, a database timing out every few statements still opens the circuit.
+    Once the reset time has passed a single trial call is let through (half-open). Its outcome closes the circuit again or
+    re-opens it for another `reset_seconds`.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float, window_seconds: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._failures = collections.deque()
+        self._opened_at: Optional[float] = None
+        self._trial_started: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half-open" if self._trial_started is not None else "open"
+
+    def retry_after(self) -> Optional[float]:
+        """Returns None if a call may proceed, otherwise the seconds until the next trial."""
+        if self.failure_threshold <= 0:
+            return None
+        with self._lock:
+            if self._opened_at is None:
+                return None
+            now = time.monotonic()
+            remaining = self._opened_at + self.reset_seconds - now
+            if remaining > 0:
+                return remaining
+            # a trial that never reported back doesn't block further trials forever
+            if self._trial_started is not None and now - self._trial_started < self.reset_seconds:
+                return self._trial_started + self.reset_seconds - now
+            self._trial_started = now
+            return None
+
+    def record_success(self):
+        with self._lock:
+            # only the trial closes an open circuit, not a statement that started before it opened
+            if self._trial_started is not None:
+                logger.info("Database circuit closed")
+                self._failures.clear()
+                self._opened_at = None
+                self._trial_started = None
+
+    def record_failure(self):
+        with self._lock:
+            now = time.monotonic()
+            self._failures.append(now)
+            while self._failures[0] <= now - self.window_seconds:
+                self._failures.popleft()
+            if self._trial_started is not None or (self._opened_at is None and 0 < self.failure_threshold <= len(self._failures)):
+                logger.warning(f"Database circuit opened after {len(self._failures)} failures within {self.window_seconds}s")
+                self._opened_at = now
+            self._trial_started = None
+
+
+class _Replica:
+    def __init__(self, host: str, port: int, failure_threshold: int, reset_seconds: float):
+        self.host = host
+        self.port = port
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+        self.lag: Optional[float] = None
+        self.lag_checked = 0.0
+
+    def __str__(self):
+        return f"{self.host}:{self.port}"
+
+
+class ReplicaRouter:
+    """Picks the read replica for a read-only connection, or None for the primary.
+
+    Replicas are used round robin. A replica is skipped while its own circuit breaker is open or while its replication lag
+    exceeds `max_lag_seconds`, the lag is re-checked on the replica connection itself every `lag_check_seconds`. Devices
+    that wrote within `read_your_writes_seconds` read from the primary. A server that doesn't replicate at all has an
+    unknown lag and is skipped, unless `stand_in` allows it to stand in for a replica.
+    """
+
+    def __init__(self, replicas: list[tuple[str, int]], max_lag_seconds: float, read_your_writes_seconds: float, lag_check_seconds: float = 2.0,
+                 failure_threshold: int = 5, reset_seconds: float = 10, stand_in: bool = False):
+        self.replicas = [_Replica(host, port, failure_threshold, reset_seconds) for (host, port) in replicas]
+        self.max_lag_seconds = max_lag_seconds
+        self.stand_in = stand_in
+        self.read_your_writes_seconds = read_your_writes_seconds
+        self.lag_check_seconds = lag_check_seconds
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._writes: dict[str, float] = {}
+
+    def wrote(self, device: Optional[str]):
+        if not device or not self.replicas:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._writes[device] = now
+            if len(self._writes) > 10000:
+                self._writes = {d: at for d, at in self._writes.items() if now - at < self.read_your_writes_seconds}
+
+    def choose(self, device: Optional[str]) -> Optional[_Replica]:
+        if not self.replicas:
+            return None
+        now = time.monotonic()
+        if device and now - self._writes.get(device, float("-inf")) < self.read_your_writes_seconds:
+            return None
+        start = next(self._next)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            lagging = replica.lag is None or replica.lag > self.max_lag_seconds
+            # a lagging replica is still tried once its lag is due for a re-check
+            if lagging and now - replica.lag_checked < self.lag_check_seconds:
+                continue
+            if replica.breaker.retry_after() is None:
+                return replica
+        return None
+
+    def needs_lag_check(self, replica: _Replica) -> bool:
+        return time.monotonic() - replica.lag_checked >= self.lag_check_seconds
+
+    def lag_checked(self, replica: _Replica, lag: Optional[float]):
+        # warn once when the replica becomes unusable, or right away if it never was usable
+        usable_before = not replica.lag_checked or (replica.lag is not None and replica.lag <= self.max_lag_seconds)
+        if (lag is None or lag > self.max_lag_seconds) and usable_before:
+            behind = f"lags {lag}s behind" if lag is not None else "doesn't replicate or replication is broken"
+            logger.warning(f"Replica {replica} {behind}, reading from the primary")
+        replica.lag = lag
+        replica.lag_checked = time.monotonic()
+
+    def status(self) -> list[dict]:
+        return [{"replica": str(replica), "lag": replica.lag, "circuit": replica.breaker.state} for replica in self.replicas]
+
+
+class _Cursor:
+    """Cursor proxy that feeds statement outcomes into the circuit breaker and request trace and optionally injects latency."""
+
+    def __init__(self, cursor, connection: "DbConnection"):
+        self._cursor = cursor
+        self._connection = connection
+
+    def execute(self, operation, params=None, *args, **kwargs):
+        return self._run(self._cursor.execute, operation, params, *args, **kwargs)
+
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        return self._run(self._cursor.executemany, operation, seq_params, *args, **kwargs)
+
+    def _run(self, fn, operation, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            DbConnection.inject_latency()
+            result = fn(operation, *args, **kwargs)
+        except mysql.connector.Error as e:
+            if isinstance(e, (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError)) or e.errno in _UNHEALTHY_ERRNOS:
+                self._connection.breaker.record_failure()
+            # slow or unreachable database: answered with 503 or a cached response instead of a 500
+            if e.errno in _TIMEOUT_ERRNOS:
+                raise DeadlineExceeded(f"statement timed out: {e}") from e
+            if e.errno in _UNHEALTHY_ERRNOS:
+                raise DatabaseUnavailable(f"database connection lost: {e}", math.ceil(self._connection.breaker.retry_after() or 1)) from e
+            raise
+        finally:
+            profiling.record_statement(operation, time.monotonic() - started)
+        self._connection.breaker.record_success()
+        if self._connection.replica is None and isinstance(operation, str) and _WRITE_STATEMENT.match(operation):
+            DbConnection.router.wrote(request_device())
+        return result
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __next__(self):
+        return next(self._cursor)
+
+    def __getattr__(self, item):
+        return getattr(self._cursor, item)
+
 
 class DbConnection:
     # autocommit to always wait for queries to finish?
@@ -13,10 +253,91 @@ class DbConnection:
         "database": Config.db,
         "autocommit": True
     }
+    breaker = CircuitBreaker(Config.db_circuit_failure_threshold, Config.db_circuit_reset_seconds)
+    # (base, jitter) in seconds - turns the connection into a slow database stand-in for measuring tail latency
+    injected_latency = (Config.db_inject_latency_ms / 1000, Config.db_inject_latency_jitter_ms / 1000)
+    router = ReplicaRouter(Config.db_replicas, Config.db_replica_max_lag_seconds, Config.db_read_your_writes_seconds,
+                           failure_threshold=Config.db_circuit_failure_threshold, reset_seconds=Config.db_circuit_reset_seconds,
+                           stand_in=Config.db_replica_stand_in)
+    __session_timeouts_supported = True
+
+    def __init__(self, read_only: bool = False):
+        """`read_only` connections go to a read replica if one is configured, healthy and recent enough."""
+        remaining = deadline_remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded("request deadline exceeded before connecting")
+        self.replica = None
+        self.conn = self._connect_replica(remaining) if read_only else None
+        if self.conn is None:
+            retry_after = self.breaker.retry_after()
+            if retry_after:
+                raise DatabaseUnavailable("database circuit is open", math.ceil(retry_after))
+            try:
+                self.conn = mysql.connector.connect(**self._connection_config(self.__config, remaining))
+            except mysql.connector.Error as e:
+                self.breaker.record_failure()
+                raise DatabaseUnavailable(f"unable to connect: {e}", math.ceil(self.breaker.retry_after() or 1)) from e
+        self.cur = self.cursor()
+        if remaining is not None:
+            self._apply_statement_timeouts(remaining)
+
+    def _connect_replica(self, remaining: Optional[float]):
+        replica = self.router.choose(request_device())
+        if replica is None:
+            return None
+        config = self._connection_config({**self.__config, "host": replica.host, "port": replica.port}, remaining)
+        try:
+            conn = mysql.connector.connect(**config)
+        except mysql.connector.Error as e:
+            logger.warning(f"Replica {replica} unavailable, reading from the primary: {e}")
+            replica.breaker.record_failure()
+            return None
+        try:
+            if self.router.needs_lag_check(replica):
+                try:
+                    lag = self._replication_lag(conn, self.router.stand_in)
+                except mysql.connector.Error as e:
+                    # e.g. a user without REPLICATION CLIENT privilege, skipped like a broken replica until the next check
+                    if not replica.lag_checked or replica.lag is not None:
+                        logger.warning(f"Unable to check the lag of replica {replica}: {e}")
+                    lag = None
+                self.router.lag_checked(replica, lag)
+            if replica.lag is None or replica.lag > self.router.max_lag_seconds:
+                conn.close()
+                return None
+        except BaseException:
+            conn.close()
+            raise
+        replica.breaker.record_success()
+        # statement failures on the replica count against the replica, not the primary
+        self.replica = replica
+        self.breaker = replica.breaker
+        return conn
 
-    def __init__(self):
-        self.conn = mysql.connector.connect(**self.__config)
-        self.cur = self.conn.cursor()
+    @staticmethod
+    def _connection_config(config: dict, remaining: Optional[float]) -> dict:
+        config = dict(config)
+        if remaining is not None:
+            config["connection_timeout"] = max(1, math.ceil(remaining))
+        return config
+
+    @staticmethod
+    def _replication_lag(conn, stand_in: bool = False) -> Optional[float]:
+        """Seconds the replica is behind, None if replication is broken or, unless `stand_in`, the server doesn't replicate."""
+        cursor = conn.cursor(dictionary=True)
+        try:
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+            except mysql.connector.errors.ProgrammingError:
+                # MySQL before 8.0.22 and MariaDB before 10.5
+                cursor.execute("SHOW SLAVE STATUS")
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        if not rows:
+            return 0.0 if stand_in else None
+        lag = rows[0].get("Seconds_Behind_Source", rows[0].get("Seconds_Behind_Master"))
+        return float(lag) if lag is not None else None
 
     def __enter__(self):
         return self
@@ -30,12 +351,46 @@ class DbConnection:
         self.conn.close()
 
     def cursor(self, *args, **kwargs):
-        return self.conn.cursor(*args, **kwargs)
+        return _Cursor(self.conn.cursor(*args, **kwargs), self)
+
+    def apply_deadline(self):
+        """Applies the current deadline to the following statements, for connections outliving the deadline they were opened with."""
+        remaining = deadline_remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceeded("deadline exceeded before the statement")
+            self._apply_statement_timeouts(remaining)
+
+    def _apply_statement_timeouts(self, remaining: float):
+        if not DbConnection.__session_timeouts_supported:
+            return
+        # MAX_EXECUTION_TIME only limits SELECTs, lock waits of the FOR UPDATE queries are bound by innodb_lock_wait_timeout
+        if Config.db_flavor == "mariadb":
+            statement_timeout = f"max_statement_time = {max(0.001, remaining):.3f}"
+        else:
+            statement_timeout = f"MAX_EXECUTION_TIME = {max(1, int(remaining * 1000))}"
+        try:
+            self.cur.execute(f"SET SESSION {statement_timeout}, SESSION innodb_lock_wait_timeout = {max(1, math.ceil(remaining))}")
+        except mysql.connector.errors.ProgrammingError as e:
+            logger.warning(f"Unable to set statement timeouts, continuing without: {e}")
+            DbConnection.__session_timeouts_supported = False
+
+    @classmethod
+    def inject_latency(cls):
+        base, jitter = cls.injected_latency
+        if not base and not jitter:
+            return
+        delay = base + (random.expovariate(1 / jitter) if jitter else 0)
+        remaining = deadline_remaining()
+        if remaining is not None and delay > remaining:
+            time.sleep(max(0.0, remaining))
+            raise InjectedTimeout("injected latency exceeded the statement timeout")
+        time.sleep(delay)
 
     @classmethod
-    def get_single_results(cls, *sqls):
+    def get_single_results(cls, *sqls, read_only: bool = False):
         res: list = []
-        with cls() as conn:
+        with cls(read_only=read_only) as conn:
             for sql in sqls:
                 conn.cur.execute(sql)
                 # get the first element of the cursor (tuple) - or if it's none, get a list [None]
@@ -0,0 +1,123 @@
+import dataclasses
+import datetime
+import threading
+import time
+from typing import Optional
+
+from DatetimeWrapper import DatetimeWrapper
+from db_connection import DbConnection as Db
+
+
+@dataclasses.dataclass
+class _Estimate:
+    encounters: float
+    deviation: float
+    seconds: float
+    sessions: int = 0
+
+    def add(self, encounters: float, seconds: Optional[float], alpha: float):
+        if not self.sessions:
+            self.encounters = encounters
+            self.seconds = seconds or self.seconds
+        else:
+            self.deviation += alpha * (abs(encounters - self.encounters) - self.deviation)
+            self.encounters += alpha * (encounters - self.encounters)
+            if seconds:
+                self.seconds += alpha * (seconds - self.seconds)
+        self.sessions += 1
+
+
+@dataclasses.dataclass
+class _Usage:
+    sessions: int = 0
+    relogins: int = 0
+    seconds: float = 0.0
+
+
+class DemandModel:
+    """Learns how many encounters and how much time a device spends on an account per session and purpose.
+
+    Estimates are exponentially weighted averages over the returned sessions in accounts_history, seeded by `load` and
+    updated whenever a device returns an account. The expected demand is the average plus its mean deviation, so most
+    sessions fit. Devices with too little history fall back to the estimate of their purpose.
+
+    It also counts relogins - accounts requested with reason 'limit' because the previous one ran out of encounters - per
+    device-hour of account usage and selection strategy.
+    """
+
+    def __init__(self, alpha: float = 0.2, min_sessions: int = 3, history_days: int = 7):
+        self.alpha = alpha
+        self.min_sessions = min_sessions
+        self.history_days = history_days
+        self._lock = threading.Lock()
+        self._estimates: dict[tuple[str, str], _Estimate] = {}
+        self._sessions: dict[str, tuple[str, str, float]] = {}
+        self._usage: dict[tuple[str, str], _Usage] = {}
+
+    def load(self):
+        estimates = {}
+        with Db() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT device, purpose, encounters, TIMESTAMPDIFF(SECOND, acquired, returned) FROM accounts_history"
+                               " WHERE returned > %s AND purpose IS NOT NULL AND encounters > 0 ORDER BY id",
+                               (DatetimeWrapper.now().replace(tzinfo=None) - datetime.timedelta(days=self.history_days),))
+                for (device, purpose, encounters, seconds) in cursor:
+                    for key in ((device, purpose), ("", purpose)):
+                        estimates.setdefault(key, _Estimate(0.0, 0.0, 0.0)).add(float(encounters), float(seconds or 0), self.alpha)
+            finally:
+                cursor.close()
+        with self._lock:
+            self._estimates = estimates
+
+    def expected(self, device: str, purpose: str) -> Optional[tuple[int, int]]:
+        """Encounters and seconds the device is expected to use an account for, None without enough history."""
+        with self._lock:
+            for key in ((device, purpose), ("", purpose)):
+                estimate = self._estimates.get(key)
+                if estimate and estimate.sessions >= self.min_sessions:
+                    return int(estimate.encounters + estimate.deviation), int(estimate.seconds)
+        return None
+
+    def session_started(self, device: str, purpose: str, strategy: str, reason: Optional[str], now: Optional[float] = None):
+        now = now or time.time()
+        with self._lock:
+            self._end_session(device, now)
+            self._sessions[device] = (purpose, strategy, now)
+            usage = self._usage.setdefault((purpose, strategy), _Usage())
+            usage.sessions += 1
+            usage.relogins += reason == "limit"
+
+    def session_ended(self, device: str, encounters: Optional[int], now: Optional[float] = None):
+        now = now or time.time()
+        with self._lock:
+            session = self._end_session(device, now)
+            if not session or encounters is None:
+                return
+            purpose, _, started = session
+            for key in ((device, purpose), ("", purpose)):
+                self._estimates.setdefault(key, _Estimate(0.0, 0.0, 0.0)).add(float(encounters), now - started, self.alpha)
+
+    def metrics(self) -> dict:
+        now = time.time()
+        with self._lock:
+            usage = {key: dataclasses.replace(value) for key, value in self._usage.items()}
+            for (purpose, strategy, started) in self._sessions.values():
+                usage[(purpose, strategy)].seconds += now - started
+        result = {}
+        for (purpose, strategy), value in sorted(usage.items()):
+            device_hours = value.seconds / 3600
+            result.setdefault(purpose, {})[strategy] = {
+                "sessions": value.sessions,
+                "relogins": value.relogins,
+                "device_hours": round(device_hours, 2),
+                "relogins_per_device_hour": round(value.relogins / device_hours, 3) if device_hours else None
+            }
+        return result
+
+    def _end_session(self, device: str, now: float) -> Optional[tuple[str, str, float]]:
+        session = self._sessions.pop(device, None)
+        if session:
+            purpose, strategy, started = session
+            self._usage[(purpose, strategy)].seconds += now - started
+        return session
@@ -0,0 +1,124 @@
+import csv
+import datetime
+import io
+import itertools
+from typing import Iterator, Optional
+
+from orjson import orjson
+
+from db_connection import DbConnection as Db, clear_deadline, set_deadline
+
+
+class _Export:
+    def __init__(self, columns: list[str], select: str, id_column: str, time_column: str, region_column: str, unix_time: bool):
+        self.columns = columns
+        self.select = select
+        self.id_column = id_column
+        self.time_column = time_column
+        self.region_column = region_column
+        self.unix_time = unix_time
+
+
+# passwords are never exported
+EXPORTS = {
+    "accounts": _Export(
+        columns=["id", "username", "level", "region", "purpose", "in_use_by", "last_use", "last_returned", "last_reason", "last_updated",
+                 "last_burned", "softban_time", "softban_location"],
+        select=("SELECT a.id, a.username, a.level, a.region, a.purpose, a.in_use_by, a.last_use, a.last_returned, a.last_reason, a.last_updated,"
+                " a.last_burned, a.softban_time, a.softban_location FROM accounts a"),
+        id_column="a.id", time_column="a.last_updated", region_column="a.region", unix_time=True),
+    "history": _Export(
+        columns=["id", "username", "device", "purpose", "acquired", "returned", "reason", "encounters", "region"],
+        select=("SELECT ah.id, ah.username, ah.device, ah.purpose, ah.acquired, ah.returned, ah.reason, ah.encounters, a.region"
+                "  FROM accounts_history ah LEFT JOIN accounts a ON a.username = ah.username"),
+        id_column="ah.id", time_column="ah.acquired", region_column="a.region", unix_time=False),
+}
+
+
+def parse_time(value: Optional[str]) -> Optional[datetime.datetime]:
+    """Accepts unix timestamps as well as ISO 8601 strings, naive values are treated as UTC."""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromtimestamp(float(value), datetime.timezone.utc)
+    except ValueError:
+        parsed = datetime.datetime.fromisoformat(value)
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+def export_rows(kind: str, after_id: int = 0, region: Optional[str] = None, time_from: Optional[datetime.datetime] = None,
+                time_to: Optional[datetime.datetime] = None, limit: int = 0, batch_size: int = 5000, batch_seconds: float = 30) -> Iterator[tuple]:
+    """Yields the rows of an export in id order.
+
+    Rows are fetched in keyset batches (`id > last id`), so memory stays bounded by the batch size regardless of the table
+    size and each statement stays short. Every batch runs under its own deadline of `batch_seconds` and is read completely
+    before it is handed out, a slow client never holds a statement open. Clients resume an interrupted export with the last
+    id they received.
+    """
+    export = EXPORTS[kind]
+    conditions = [f"{export.id_column} > %s"]
+    params = []
+    if region == "shared":
+        conditions.append(f"({export.region_column} IS NULL OR {export.region_column} = '')")
+    elif region:
+        conditions.append(f"{export.region_column} = %s")
+        params.append(region)
+    for bound, operator in ((time_from, ">="), (time_to, "<")):
+        if bound:
+            conditions.append(f"{export.time_column} {operator} %s")
+            params.append(int(bound.timestamp()) if export.unix_time else bound.astimezone(datetime.timezone.utc).replace(tzinfo=None))
+
+    remaining = limit if limit > 0 else None
+    last_id = after_id
+    with Db() as conn:
+        cursor = conn.cursor()
+        try:
+            while remaining is None or remaining > 0:
+                size = batch_size if remaining is None else min(batch_size, remaining)
+                set_deadline(batch_seconds)
+                try:
+                    conn.apply_deadline()
+                    cursor.execute(f"{export.select} WHERE {' AND '.join(conditions)} ORDER BY {export.id_column} LIMIT {int(size)}", (last_id, *params))
+                    rows = cursor.fetchall()
+                finally:
+                    clear_deadline()
+                for row in rows:
+                    last_id = row[0]
+                    yield row
+                if remaining is not None:
+                    remaining -= len(rows)
+                if len(rows) < size:
+                    break
+        finally:
+            cursor.close()
+
+
+def started(rows: Iterator[tuple]) -> Iterator[tuple]:
+    """Runs the export up to its first row, so an unavailable database is reported before the response status is sent."""
+    first = next(rows, None)
+    if first is None:
+        return iter(())
+    return itertools.chain((first,), rows)
+
+
+def ndjson_lines(kind: str, rows: Iterator[tuple]) -> Iterator[bytes]:
+    columns = EXPORTS[kind].columns
+    for row in rows:
+        yield orjson.dumps(dict(zip(columns, row))) + b"\n"
+
+
+def csv_lines(kind: str, rows: Iterator[tuple]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return line
+
+    writer.writerow(EXPORTS[kind].columns)
+    yield flush()
+    for row in rows:
+        writer.writerow(row)
+        yield flush()
@@ -0,0 +1,243 @@
+import bisect
+import collections
+from array import array
+import dataclasses
+import datetime
+import threading
+import time
+from typing import Iterable, Optional
+
+from DatetimeWrapper import DatetimeWrapper
+from db_connection import DbConnection as Db
+from purposes import PURPOSES, purpose_accepts_level
+from snapshot import pack_strings, unpack_strings
+
+
+@dataclasses.dataclass
+class _Account:
+    region: str
+    level: int
+    last_use: int
+    last_returned: int
+    burned: bool
+    in_use_by: Optional[str]
+    logins: collections.deque
+    eligible_at: Optional[float] = None
+
+
+class EligibilityTimeline:
+    """Keeps every free account sorted by the time it becomes eligible for selection again.
+
+    Eligibility mirrors the conditions of `_get_next_account`: accounts returned with a reason sit out the cooldown,
+    leveled accounts the short cooldown after their last use, and accounts with more than the per-hour login limit wait
+    for their logins to age out. The timeline is seeded from the database once and then kept up to date by the request
+    handlers, a periodic resync corrects any drift.
+    """
+
+    def __init__(self, cooldown_seconds: int, short_cooldown_seconds: int, account_max_logins_hour: int):
+        self.cooldown_seconds = cooldown_seconds
+        self.short_cooldown_seconds = short_cooldown_seconds
+        self.account_max_logins_hour = account_max_logins_hour
+        self._lock = threading.Lock()
+        self._accounts: dict[str, _Account] = {}
+        self._holders: dict[str, str] = {}
+        self._timeline: list[tuple[float, str]] = []
+
+    def resync(self):
+        self.load(*self._query())
+
+    def catch_up(self, last_updated: int, history_id: int):
+        """Applies the changes since a snapshot: accounts updated after `last_updated` and logins after history row `history_id`."""
+        accounts, logins = self._query("WHERE last_updated >= %s", (last_updated,), "AND id > %s", (history_id,))
+        with self._lock:
+            for row in accounts:
+                username = row[0]
+                previous = self._accounts.get(username)
+                if previous:
+                    self._unschedule(username, previous)
+                    if self._holders.get(previous.in_use_by) == username:
+                        del self._holders[previous.in_use_by]
+                account = self._build_account(row, previous.logins if previous else ())
+                self._accounts[username] = account
+                if account.in_use_by:
+                    self._holders[account.in_use_by] = username
+                self._schedule(username, account)
+            for username, acquired in logins.items():
+                account = self._accounts.get(username)
+                if not account:
+                    continue
+                self._unschedule(username, account)
+                account.logins.extend(acquired)
+                self._schedule(username, account)
+        return len(accounts)
+
+    def load(self, accounts: Iterable[tuple], logins: dict[str, list[float]]):
+        loaded = {row[0]: self._build_account(row, logins.get(row[0], ())) for row in accounts}
+        with self._lock:
+            self._accounts = loaded
+            self._holders = {account.in_use_by: username for username, account in loaded.items() if account.in_use_by}
+            self._timeline = []
+            for username, account in loaded.items():
+                self._schedule(username, account)
+
+    def export_state(self) -> dict[str, bytes]:
+        with self._lock:
+            usernames = list(self._accounts)
+            accounts = [self._accounts[username] for username in usernames]
+            return {
+                "timeline.users": pack_strings(usernames),
+                "timeline.regions": pack_strings([account.region for account in accounts]),
+                "timeline.in_use_by": pack_strings([account.in_use_by for account in accounts]),
+                "timeline.level": array("i", [account.level for account in accounts]).tobytes(),
+                "timeline.last_use": array("q", [account.last_use for account in accounts]).tobytes(),
+                "timeline.returned": array("q", [account.last_returned for account in accounts]).tobytes(),
+                "timeline.burned": array("b", [account.burned for account in accounts]).tobytes(),
+                "timeline.nlogins": array("H", [len(account.logins) for account in accounts]).tobytes(),
+                "timeline.logins": array("d", [login for account in accounts for login in account.logins]).tobytes(),
+            }
+
+    def restore_state(self, sections: dict[str, bytes]):
+        columns = {}
+        for name, typecode in (("level", "i"), ("last_use", "q"), ("returned", "q"), ("burned", "b"), ("nlogins", "H"), ("logins", "d")):
+            columns[name] = array(typecode)
+            columns[name].frombytes(sections[f"timeline.{name}"])
+        count = len(columns["level"])
+        usernames = unpack_strings(sections["timeline.users"], count)
+        regions = unpack_strings(sections["timeline.regions"], count)
+        in_use_by = unpack_strings(sections["timeline.in_use_by"], count)
+
+        accounts = []
+        logins = {}
+        offset = 0
+        for i, username in enumerate(usernames):
+            accounts.append((username, regions[i], columns["level"][i], in_use_by[i], columns["last_use"][i], columns["returned"][i], columns["burned"][i]))
+            logins[username] = columns["logins"][offset:offset + columns["nlogins"][i]]
+            offset += columns["nlogins"][i]
+        self.load(accounts, logins)
+
+    @staticmethod
+    def _query(accounts_filter: str = "", accounts_params: tuple = (), history_filter: str = "", history_params: tuple = ()):
+        logins = collections.defaultdict(list)
+        with Db() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"SELECT username, region, level, in_use_by, last_use, last_returned, last_reason IS NOT NULL FROM accounts {accounts_filter}",
+                               accounts_params)
+                accounts = cursor.fetchall()
+                # acquired is written in UTC, neither the database's clock nor its time zone apply
+                cursor.execute(f"SELECT username, acquired FROM accounts_history"
+                               f" WHERE acquired > %s {history_filter} ORDER BY acquired",
+                               (DatetimeWrapper.now().replace(tzinfo=None) - datetime.timedelta(hours=1), *history_params))
+                for (username, acquired) in cursor:
+                    logins[username].append(acquired.replace(tzinfo=datetime.timezone.utc).timestamp())
+            finally:
+                cursor.close()
+        return accounts, logins
+
+    def _build_account(self, row: tuple, logins: Iterable[float]) -> _Account:
+        (username, region, level, in_use_by, last_use, last_returned, burned) = row
+        return _Account(region=region or "shared", level=int(level or 0), last_use=int(last_use or 0), last_returned=int(last_returned or 0),
+                        burned=bool(burned), in_use_by=in_use_by or None, logins=collections.deque(logins, maxlen=self.account_max_logins_hour + 1))
+
+    def claimed(self, username: str, device: str, now: Optional[float] = None):
+        now = now or time.time()
+        with self._lock:
+            account = self._accounts.get(username)
+            if not account:
+                return
+            self._unschedule(username, account)
+            # a device reusing the account it holds only updates its open history row, that's no new login
+            if account.in_use_by != device:
+                account.logins.append(now)
+            self._holders.pop(account.in_use_by, None)
+            account.in_use_by = device
+            account.last_use = int(now)
+            account.burned = False
+            self._holders[device] = username
+
+    def returned(self, device: str, burned: bool, level: Optional[int] = None, now: Optional[float] = None):
+        now = now or time.time()
+        with self._lock:
+            username = self._release(device)
+            if not username:
+                return
+            account = self._accounts[username]
+            account.last_returned = int(now)
+            account.burned = burned
+            if level and level > account.level:
+                account.level = level
+            self._schedule(username, account)
+
+    def reset(self, device: str):
+        """The device dropped its account without returning it, eligibility stays as it was before the claim."""
+        with self._lock:
+            username = self._release(device)
+            if username:
+                self._schedule(username, self._accounts[username])
+
+    def released(self, username: str):
+        """The account was taken away from its device without being returned, e.g. by the reconciler."""
+        with self._lock:
+            account = self._accounts.get(username)
+            if not account or not account.in_use_by:
+                return
+            if self._holders.get(account.in_use_by) == username:
+                del self._holders[account.in_use_by]
+            account.in_use_by = None
+            self._schedule(username, account)
+
+    def holders(self) -> dict[str, str]:
+        """Account by device holding it."""
+        with self._lock:
+            return dict(self._holders)
+
+    def histogram(self, bucket_seconds: int, horizon_seconds: int, now: Optional[float] = None) -> dict:
+        now = now or time.time()
+        buckets = max(1, horizon_seconds // bucket_seconds)
+        result = {}
+        with self._lock:
+            for (eligible_at, username) in self._timeline:
+                account = self._accounts[username]
+                for purpose in PURPOSES:
+                    if not purpose_accepts_level(purpose, account.level):
+                        continue
+                    entry = result.setdefault(account.region, {}).setdefault(purpose, {"available": 0, "upcoming": [0] * buckets, "later": 0})
+                    if eligible_at <= now:
+                        entry["available"] += 1
+                    elif eligible_at < now + buckets * bucket_seconds:
+                        entry["upcoming"][int((eligible_at - now) // bucket_seconds)] += 1
+                    else:
+                        entry["later"] += 1
+        return result
+
+    def _release(self, device: str) -> Optional[str]:
+        username = self._holders.pop(device, None)
+        if username not in self._accounts:
+            return None
+        self._accounts[username].in_use_by = None
+        return username
+
+    def _eligible_at(self, account: _Account) -> float:
+        eligible_at = 0.0
+        if account.burned:
+            eligible_at = account.last_returned + self.cooldown_seconds
+        if account.level >= 30:
+            eligible_at = max(eligible_at, account.last_use + self.short_cooldown_seconds)
+        if len(account.logins) > self.account_max_logins_hour:
+            eligible_at = max(eligible_at, account.logins[0] + 3600)
+        return eligible_at
+
+    def _schedule(self, username: str, account: _Account):
+        if account.in_use_by:
+            account.eligible_at = None
+            return
+        account.eligible_at = self._eligible_at(account)
+        bisect.insort(self._timeline, (account.eligible_at, username))
+
+    def _unschedule(self, username: str, account: _Account):
+        if account.eligible_at is None:
+            return
+        index = bisect.bisect_left(self._timeline, (account.eligible_at, username))
+        if index < len(self._timeline) and self._timeline[index] == (account.eligible_at, username):
+            del self._timeline[index]
+        account.eligible_at = None
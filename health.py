@@ -0,0 +1,21 @@
+from typing import Optional
+
+# every returned session moves an account's health (0-100) towards the target of the reason it was returned with,
+# sessions returned with other reasons (reset, reconciled) don't tell anything about the account
+HEALTH_TARGETS = {
+    "maintenance": 0,
+    "nologin": 0,
+    "teleport": 60,
+    "logout": 100,
+    "rotation": 100,
+    "limit": 100,
+    "level": 100,
+}
+HEALTH_ALPHA = 0.3
+
+
+def health_update_query(username: str, reason: Optional[str]) -> Optional[str]:
+    target = HEALTH_TARGETS.get(reason)
+    if target is None:
+        return None
+    return f"UPDATE accounts SET health = ROUND(health + ({target} - health) * {HEALTH_ALPHA}) WHERE username = '{username}'"
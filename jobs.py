@@ -0,0 +1,33 @@
+import threading
+from typing import Callable
+
+from loguru import logger
+
+from db_connection import DatabaseUnavailable
+
+
+class PeriodicJob(threading.Thread):
+    """Runs `fn` every `interval_seconds` in a daemon thread, the first time after `first_run_after` seconds."""
+
+    def __init__(self, name: str, interval_seconds: float, fn: Callable[[], None], first_run_after: float = 0):
+        super().__init__(name=name, daemon=True)
+        self.interval_seconds = interval_seconds
+        self.fn = fn
+        self.first_run_after = first_run_after
+        self._stop_event = threading.Event()
+
+    def run(self):
+        job_logger = logger.bind(name=self.name)
+        job_logger.info(f"Starting, running every {self.interval_seconds}s")
+        self._stop_event.wait(self.first_run_after)
+        while not self._stop_event.is_set():
+            try:
+                self.fn()
+            except DatabaseUnavailable as ex:
+                job_logger.warning(f"Skipping run, database unavailable: {ex}")
+            except Exception as ex:
+                job_logger.opt(exception=True).error(f"Run failed: {ex}")
+            self._stop_event.wait(self.interval_seconds)
+
+    def stop(self):
+        self._stop_event.set()
@@ -1,7 +1,89 @@
+import atexit
+import queue
+import random
+import re
 import sys
+import threading
+import time
+
 from loguru import logger
 from config import Config
 
+_CREDENTIALS = re.compile(r"""(\b(?:password|passwd|pass|pw)['"]?\s*[:=]\s*)(?:'[^']*'|"[^"]*"|[^'",\s})]+)""", re.IGNORECASE)
+
+
+def redact_credentials(record):
+    record["message"] = _CREDENTIALS.sub(r"\1***", record["message"])
+
+
+class LogSampler:
+    """Loguru filter thinning out records below WARNING per device and function.
+
+    Records are sampled with `sample_rate` and then limited to `rate` per second (bursts up to `burst`) per key, so a single
+    chatty device or route can't flood the sink. Warnings and errors always pass.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, rate: float = 0.0, burst: int = 20):
+        self.sample_rate = sample_rate
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets: dict[tuple, list[float]] = {}
+
+    def __call__(self, record) -> bool:
+        if record["level"].no >= 30:
+            return True
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        if self.rate <= 0:
+            return True
+        key = (record["extra"].get("name"), record["function"])
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.setdefault(key, [float(self.burst), now])
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+        return True
+
+
+class BackgroundWriter:
+    """File-like sink handing formatted messages to a daemon thread that writes them to `stream`.
+
+    Unlike loguru's `enqueue`, which pickles every record into a multiprocessing queue, messages stay in the process, so a
+    request thread only pays for formatting and a queue put. A full queue blocks the caller rather than dropping records.
+    """
+
+    def __init__(self, stream, max_queued: int = 10000):
+        self.stream = stream
+        self._queue = queue.Queue(max_queued)
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.drain)
+
+    def write(self, message: str):
+        self._queue.put(message)
+
+    def drain(self):
+        """Blocks until every queued message is written."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            try:
+                self.stream.write(message)
+                if self._queue.empty():
+                    self.stream.flush()
+            except Exception as ex:
+                # like loguru's catch: report on stderr and keep the writer alive, or callers would block on a full queue
+                sys.stderr.write(f"--- Logging error in BackgroundWriter: {ex!r} ---\n")
+            finally:
+                self._queue.task_done()
+
+
 def setup_logger():
     log_fmt_time = "[<cyan>{time:MM-DD HH:mm:ss.SS}</cyan>]"
     log_fmt_id = "[<cyan>{extra[name]: >12}</cyan>]"
@@ -13,9 +95,12 @@ def setup_logger():
     log_format_console = ' '.join(log_format_c)
 
     logger.remove()
-    logger.add(sys.stdout, format=log_format_console, level=Config.loglevel, colorize=True)
+    # request threads only hand formatted records to a queue, a background thread writes them
+    logger.add(BackgroundWriter(sys.stdout), format=log_format_console, level=Config.loglevel, colorize=not Config.log_json,
+               serialize=Config.log_json, filter=LogSampler(sample_rate=Config.log_sample_rate, rate=Config.log_rate_limit))
 
     logconfig = {
         "extra": {"name": ""},
+        "patcher": redact_credentials,
     }
-    logger.configure(**logconfig)
\ No newline at end of file
+    logger.configure(**logconfig)
@@ -0,0 +1,106 @@
+import collections
+import os
+import sys
+import threading
+import time
+from typing import Optional
+
+_trace = threading.local()
+
+
+class RequestTrace:
+    def __init__(self, handler: str):
+        self.handler = handler
+        self.started = time.monotonic()
+        self.status: Optional[int] = None
+        self.statements: list[tuple[str, float]] = []
+        self.counters: dict[str, int] = {}
+
+    def to_dict(self, duration: float) -> dict:
+        return {
+            "handler": self.handler,
+            "status": self.status,
+            "duration_ms": round(duration * 1000, 1),
+            "db_ms": round(sum(seconds for (_, seconds) in self.statements) * 1000, 1),
+            "counters": self.counters,
+            "statements": [{"sql": sql, "ms": round(seconds * 1000, 1)} for (sql, seconds) in self.statements]
+        }
+
+
+def start_trace(handler: str) -> RequestTrace:
+    _trace.current = RequestTrace(handler)
+    return _trace.current
+
+
+def end_trace() -> Optional[RequestTrace]:
+    trace = getattr(_trace, "current", None)
+    _trace.current = None
+    return trace
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return getattr(_trace, "current", None)
+
+
+def record_statement(sql, seconds: float):
+    trace = getattr(_trace, "current", None)
+    if trace is not None:
+        trace.statements.append((sql if isinstance(sql, str) else str(sql), seconds))
+
+
+def count(name: str, amount: int = 1):
+    trace = getattr(_trace, "current", None)
+    if trace is not None:
+        trace.counters[name] = trace.counters.get(name, 0) + amount
+
+
+class SlowRequestLog:
+    """Keeps the traces of the last `size` requests that took at least `threshold_seconds`."""
+
+    def __init__(self, threshold_seconds: float, size: int = 50):
+        self.threshold_seconds = threshold_seconds
+        self._entries = collections.deque(maxlen=size)
+
+    def add(self, trace: RequestTrace) -> Optional[dict]:
+        duration = time.monotonic() - trace.started
+        if self.threshold_seconds <= 0 or duration < self.threshold_seconds:
+            return None
+        entry = {"time": time.time(), **trace.to_dict(duration)}
+        self._entries.append(entry)
+        return entry
+
+    def entries(self) -> list[dict]:
+        return list(self._entries)
+
+
+class SamplingProfiler:
+    """Samples the stacks of all other threads and aggregates them in the folded format of flamegraph.pl/speedscope."""
+
+    def __init__(self, interval_seconds: float = 0.005):
+        self.interval_seconds = interval_seconds
+        self._running = threading.Lock()
+
+    def profile(self, seconds: float) -> Optional[str]:
+        """Returns the folded stacks, or None if another profile is already running."""
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            own = threading.get_ident()
+            stacks = collections.Counter()
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own:
+                        continue
+                    frames = []
+                    while frame is not None:
+                        code = frame.f_code
+                        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    frames.append(names.get(thread_id, str(thread_id)))
+                    stacks[";".join(reversed(frames))] += 1
+                time.sleep(self.interval_seconds)
+            return "\n".join(f"{stack} {samples}" for stack, samples in stacks.most_common()) + "\n"
+        finally:
+            self._running.release()
@@ -0,0 +1,37 @@
+from typing import Optional
+
+# IV_QUEST = "quest_iv"
+# LEVEL = "level"
+# QUEST = "quest"
+# IV = "iv"
+# MON_RAID = "mon_raid"
+
+# level range (minimum, maximum exclusive) of the accounts served for a purpose, None = unbounded
+PURPOSE_LEVELS: dict[str, tuple[Optional[int], Optional[int]]] = {
+    "iv": (30, None),
+    "quest": (30, None),
+    "quest_iv": (30, None),
+    "mon_raid": (8, None),
+    "level": (None, 30),
+}
+PURPOSES = tuple(PURPOSE_LEVELS)
+
+
+def purpose_level_bounds(purpose: str) -> tuple[Optional[int], Optional[int]]:
+    return PURPOSE_LEVELS.get(purpose, (None, None))
+
+
+def purpose_level_query(purpose: str) -> str:
+    minimum, maximum = purpose_level_bounds(purpose)
+    conditions = []
+    if minimum is not None:
+        conditions.append(f"level >= {minimum}")
+    if maximum is not None:
+        conditions.append(f"level < {maximum}")
+    return f" ({' AND '.join(conditions) or '1=1'})"
+
+
+def purpose_accepts_level(purpose: str, level: int) -> bool:
+    """In-memory counterpart of `purpose_level_query`."""
+    minimum, maximum = purpose_level_bounds(purpose)
+    return (minimum is None or level >= minimum) and (maximum is None or level < maximum)
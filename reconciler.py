@@ -0,0 +1,184 @@
+import collections
+import datetime
+import threading
+import time
+from typing import Callable, Optional
+
+from loguru import logger
+
+from DatetimeWrapper import DatetimeWrapper
+from db_connection import DbConnection as Db, clear_deadline, set_deadline
+
+
+class Reconciler:
+    """Repairs drift between `accounts` and `accounts_history` in small batches.
+
+    Open history rows (`returned IS NULL`) are walked in id order along the `returned` index. A row is closed with reason
+    'reconciled' when a newer row of the same account exists, or when its device doesn't hold the account anymore. Accounts
+    in use are walked in id order as well. A device holding several accounts keeps the one it claimed last, the others are
+    released together with their open history rows.
+
+    Each table is walked by keyset: the last id seen is the watermark of the next batch and a pass ends at the end of the
+    table, the next run starts over. Rows whose account changed within `grace_seconds` are left alone, the request handlers
+    may still be writing them, and repairs only apply if the row is unchanged since it was read.
+
+    The reconciler yields to request traffic: a batch only starts while `busy()` is false, every statement runs under a
+    short deadline (statement and lock wait timeouts) and the time spent working is limited to `duty_cycle`.
+    """
+
+    def __init__(self, batch_size: int = 200, duty_cycle: float = 0.1, grace_seconds: int = 300, statement_seconds: float = 2.0,
+                 busy: Optional[Callable[[], bool]] = None, on_released: Optional[Callable[[str, str], None]] = None,
+                 max_wait_seconds: float = 30.0):
+        self.batch_size = batch_size
+        self.duty_cycle = min(1.0, max(0.01, duty_cycle))
+        self.grace_seconds = grace_seconds
+        self.statement_seconds = statement_seconds
+        self.busy = busy or (lambda: False)
+        self.on_released = on_released or (lambda device, username: None)
+        self.max_wait_seconds = max_wait_seconds
+        self._lock = threading.Lock()
+        self._watermarks = {"history": 0, "accounts": 0}
+        self._found = collections.Counter()
+        self._repaired = collections.Counter()
+        self._passes = collections.Counter()
+        self._recent = collections.deque(maxlen=50)
+        # accounts in use without open history row, counted per pass as they stay until released
+        self._missing_history = [0, None]
+        self._last_run: Optional[dict] = None
+
+    def run(self):
+        started = time.time()
+        scanned = {}
+        for table, batch in (("history", self._history_batch), ("accounts", self._accounts_batch)):
+            scanned[table] = self._walk(table, batch)
+        with self._lock:
+            self._last_run = {"started": int(started), "duration": round(time.time() - started, 1), "scanned": scanned,
+                              "watermarks": dict(self._watermarks)}
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "found": dict(self._found),
+                "repaired": dict(self._repaired),
+                "passes": dict(self._passes),
+                "missing_history": self._missing_history[1],
+                "watermarks": dict(self._watermarks),
+                "last_run": self._last_run,
+                "recent": list(self._recent)
+            }
+
+    def _walk(self, table: str, batch: Callable[[int], tuple[int, int]]) -> int:
+        """Runs batches until the end of the table or until traffic keeps the reconciler waiting. Returns the rows scanned."""
+        scanned = 0
+        while True:
+            if not self._wait_until_idle():
+                logger.debug(f"Reconciler yielding to traffic, {table} resumes after id {self._watermarks[table]}")
+                return scanned
+            batch_started = time.monotonic()
+            set_deadline(self.statement_seconds)
+            try:
+                rows, last_id = batch(self._watermarks[table])
+            finally:
+                clear_deadline()
+            scanned += rows
+            with self._lock:
+                if rows < self.batch_size:
+                    self._watermarks[table] = 0
+                    self._passes[table] += 1
+                else:
+                    self._watermarks[table] = last_id
+            if rows < self.batch_size:
+                return scanned
+            elapsed = time.monotonic() - batch_started
+            time.sleep(elapsed * (1 / self.duty_cycle - 1))
+
+    def _wait_until_idle(self) -> bool:
+        waited_until = time.monotonic() + self.max_wait_seconds
+        while self.busy():
+            if time.monotonic() > waited_until:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def _history_batch(self, after_id: int) -> tuple[int, int]:
+        # history times are written in UTC and last_updated from the server clock, the database's clock may differ
+        now = DatetimeWrapper.now().replace(tzinfo=None)
+        settled = int(time.time()) - self.grace_seconds
+        with Db() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    "SELECT ah.id, ah.device, ah.username, a.in_use_by,"
+                    "       EXISTS(SELECT 1 FROM accounts_history nh WHERE nh.username = ah.username AND nh.id > ah.id) superseded"
+                    "  FROM accounts_history ah LEFT JOIN accounts a ON a.username = ah.username"
+                    " WHERE ah.returned IS NULL AND ah.id > %s"
+                    "   AND ah.acquired < %s"
+                    "   AND COALESCE(a.last_updated, 0) < %s"
+                    " ORDER BY ah.id LIMIT %s", (after_id, now - datetime.timedelta(seconds=self.grace_seconds), settled, self.batch_size))
+                rows = cursor.fetchall()
+                stale = []
+                for (history_id, device, username, in_use_by, superseded) in rows:
+                    kind = "superseded_history" if superseded else "orphaned_history" if in_use_by != device else None
+                    if kind:
+                        self._found_row(kind, history_id, device, username)
+                        stale.append(history_id)
+                if stale:
+                    # the account may have been claimed again since it was read
+                    cursor.execute(
+                        f"UPDATE accounts_history ah LEFT JOIN accounts a ON a.username = ah.username"
+                        f"   SET ah.returned = %s, ah.reason = 'reconciled'"
+                        f" WHERE ah.id IN ({','.join(['%s'] * len(stale))}) AND ah.returned IS NULL"
+                        f"   AND COALESCE(a.last_updated, 0) < %s", (now, *stale, settled))
+                    self._repaired_rows("history", cursor.rowcount)
+            finally:
+                cursor.close()
+        return len(rows), rows[-1][0] if rows else after_id
+
+    def _accounts_batch(self, after_id: int) -> tuple[int, int]:
+        with Db() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    "SELECT a.id, a.username, a.in_use_by, a.last_updated,"
+                    "       EXISTS(SELECT 1 FROM accounts b WHERE b.in_use_by = a.in_use_by"
+                    "                 AND (b.last_use > a.last_use OR (b.last_use = a.last_use AND b.id > a.id))) superseded,"
+                    "       EXISTS(SELECT 1 FROM accounts_history ah WHERE ah.username = a.username AND ah.device = a.in_use_by"
+                    "                 AND ah.returned IS NULL) has_history"
+                    "  FROM accounts a"
+                    " WHERE a.in_use_by IS NOT NULL AND a.id > %s"
+                    " ORDER BY a.id LIMIT %s", (after_id, self.batch_size))
+                rows = cursor.fetchall()
+                if not after_id:
+                    self._missing_history[0] = 0
+                for (account_id, username, device, last_updated, superseded, has_history) in rows:
+                    if int(last_updated or 0) >= time.time() - self.grace_seconds:
+                        continue
+                    if not has_history:
+                        # nothing to repair safely, a history row can't be made up
+                        self._missing_history[0] += 1
+                    if not superseded:
+                        continue
+                    self._found_row("multiple_accounts", account_id, device, username)
+                    cursor.execute("UPDATE accounts SET in_use_by = NULL, last_updated = %s"
+                                   " WHERE id = %s AND in_use_by = %s AND last_updated = %s", (int(time.time()), account_id, device, last_updated))
+                    if cursor.rowcount:
+                        cursor.execute("UPDATE accounts_history SET returned = %s, reason = 'reconciled'"
+                                       " WHERE username = %s AND device = %s AND returned IS NULL",
+                                       (DatetimeWrapper.now().replace(tzinfo=None), username, device))
+                        self._repaired_rows("accounts", 1)
+                        self.on_released(device, username)
+                if len(rows) < self.batch_size:
+                    self._missing_history[1] = self._missing_history[0]
+            finally:
+                cursor.close()
+        return len(rows), rows[-1][0] if rows else after_id
+
+    def _found_row(self, kind: str, row_id: int, device: Optional[str], username: str):
+        logger.bind(name=device or "").info(f"Reconciler: {kind} (id {row_id}, account {username})")
+        with self._lock:
+            self._found[kind] += 1
+            self._recent.append({"time": int(time.time()), "kind": kind, "id": row_id, "device": device, "username": username})
+
+    def _repaired_rows(self, table: str, count: int):
+        with self._lock:
+            self._repaired[table] += count
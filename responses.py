@@ -0,0 +1,70 @@
+import gzip
+import os
+import threading
+import time
+from typing import Optional
+
+from flask import request
+from orjson import orjson
+
+
+class ResourceVersions:
+    """Version counters for the account pool and per device, used to derive ETags without touching the database.
+
+    Every write that changes what /stats or /get/<device>/info would return bumps the matching counter. Since cooldowns
+    expire with time alone, ETags additionally roll over every `max_age_seconds`. A read replica may not have seen a change
+    yet, `changed_within` tells whether a versioned payload has to be read from the primary.
+    """
+
+    def __init__(self, max_age_seconds: int = 60):
+        self.max_age_seconds = max(1, max_age_seconds)
+        # distinguishes ETags of different server runs, counters start at 0 again after a restart
+        self._boot_id = os.urandom(4).hex()
+        self._lock = threading.Lock()
+        self._pool = 0
+        self._devices: dict[str, int] = {}
+        # monotonic time of the last change, pool under the key None
+        self._changed_at: dict[Optional[str], float] = {}
+
+    def changed(self, device: Optional[str] = None):
+        now = time.monotonic()
+        with self._lock:
+            self._pool += 1
+            self._changed_at[None] = now
+            if device:
+                self._devices[device] = self._devices.get(device, 0) + 1
+                self._changed_at[device] = now
+
+    def changed_within(self, seconds: float, device: Optional[str] = None) -> bool:
+        """Whether the pool, or the device if given, changed within the last `seconds`."""
+        return time.monotonic() - self._changed_at.get(device, float("-inf")) < seconds
+
+    def pool_etag(self, *extra) -> str:
+        return self._etag("p", self._pool, *extra)
+
+    def device_etag(self, device: str) -> str:
+        return self._etag("d", self._devices.get(device, 0), device)
+
+    def _etag(self, *parts) -> str:
+        bucket = int(time.time()) // self.max_age_seconds
+        return '"' + "-".join(str(part) for part in (self._boot_id, bucket, *parts)) + '"'
+
+
+def not_modified(etag: str, headers: dict):
+    """Returns a 304 response if the client already holds `etag`, otherwise None."""
+    # werkzeug parses If-None-Match into unquoted tags
+    if request.if_none_match.contains(etag.strip('"')):
+        return b"", 304, {**headers, "ETag": etag}
+    return None
+
+
+def encode(data, code: int, headers: dict, etag: Optional[str] = None, compress_min_bytes: int = 0):
+    body = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    headers = dict(headers)
+    if etag:
+        headers["ETag"] = etag
+    if 0 < compress_min_bytes <= len(body) and "gzip" in request.accept_encodings:
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return body, code, headers
@@ -0,0 +1,95 @@
+import datetime
+from typing import Optional
+
+from loguru import logger
+
+from DatetimeWrapper import DatetimeWrapper
+from db_connection import DbConnection as Db
+
+
+class HistoryRollup:
+    """Maintains `accounts_history_hourly`, counts and encounter sums per hour x region x purpose x reason.
+
+    History rows are final once `returned` is set, so the rollup folds in closed rows in `returned` order and remembers the
+    last folded timestamp as watermark in `rollup_state`. Rows returned within the last `grace_seconds` are left for the
+    next run, concurrent writers may still commit rows with slightly older timestamps.
+    """
+
+    name = "history_hourly"
+
+    def __init__(self, grace_seconds: int = 60, max_span_hours: int = 24):
+        self.grace_seconds = grace_seconds
+        self.max_span_hours = max_span_hours
+
+    def update(self):
+        while self._fold_next_span():
+            pass
+
+    def _fold_next_span(self) -> bool:
+        """Folds at most `max_span_hours` of history into the rollup. Returns whether there is more to fold."""
+        with Db() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT watermark FROM rollup_state WHERE name = %s", (self.name,))
+                elem = cursor.fetchone()
+                watermark = elem[0] if elem else None
+                if not watermark:
+                    cursor.execute("SELECT MIN(returned) - INTERVAL 1 SECOND FROM accounts_history")
+                    watermark = cursor.fetchone()[0]
+                    if not watermark:
+                        return False
+                # `returned` is written in UTC by the server, the database's NOW() may be in another time zone
+                settled = DatetimeWrapper.now().replace(tzinfo=None) - datetime.timedelta(seconds=self.grace_seconds)
+                upper = min(settled, watermark + datetime.timedelta(hours=self.max_span_hours))
+                if upper <= watermark:
+                    return False
+
+                conn.conn.start_transaction()
+                cursor.execute(
+                    "INSERT INTO accounts_history_hourly (hour, region, purpose, reason, events, encounters)"
+                    "     SELECT TIMESTAMP(DATE(ah.returned), MAKETIME(HOUR(ah.returned), 0, 0)), COALESCE(a.region, ''), COALESCE(ah.purpose, ''),"
+                    "            COALESCE(ah.reason, ''), COUNT(*), COALESCE(SUM(ah.encounters), 0)"
+                    "       FROM accounts_history ah LEFT JOIN accounts a ON a.username = ah.username"
+                    "      WHERE ah.returned > %s AND ah.returned <= %s"
+                    "   GROUP BY 1, 2, 3, 4"
+                    " ON DUPLICATE KEY UPDATE events = events + VALUES(events), encounters = encounters + VALUES(encounters)",
+                    (watermark, upper))
+                cursor.execute("INSERT INTO rollup_state (name, watermark) VALUES (%s, %s) ON DUPLICATE KEY UPDATE watermark = VALUES(watermark)",
+                               (self.name, upper))
+                conn.conn.commit()
+                logger.debug(f"Rolled up history until {upper}")
+                return upper < settled
+            except Exception:
+                conn.conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    @staticmethod
+    def query(time_from: datetime.datetime, time_to: datetime.datetime, region: Optional[str] = None, purpose: Optional[str] = None,
+              reason: Optional[str] = None) -> list[dict]:
+        conditions = ["hour >= %s", "hour < %s"]
+        params = [time_from.astimezone(datetime.timezone.utc).replace(tzinfo=None), time_to.astimezone(datetime.timezone.utc).replace(tzinfo=None)]
+        for column, value in (("region", region), ("purpose", purpose), ("reason", reason)):
+            if value is not None:
+                conditions.append(f"{column} = %s")
+                params.append('' if column == "region" and value == "shared" else value)
+
+        result = []
+        with Db() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"SELECT hour, region, purpose, reason, events, encounters FROM accounts_history_hourly"
+                               f" WHERE {' AND '.join(conditions)} ORDER BY hour, region, purpose, reason", tuple(params))
+                for (hour, row_region, row_purpose, row_reason, events, encounters) in cursor:
+                    result.append({
+                        "hour": hour,
+                        "region": row_region or "shared",
+                        "purpose": row_purpose or None,
+                        "reason": row_reason or None,
+                        "events": int(events),
+                        "encounters": int(encounters)
+                    })
+            finally:
+                cursor.close()
+        return result
@@ -0,0 +1,189 @@
+import dataclasses
+import threading
+import time
+from typing import Optional
+
+from purposes import purpose_level_query
+
+
+@dataclasses.dataclass
+class Queued:
+    position: int
+    eta_seconds: Optional[float]
+    retry_after: int
+    reason: str = "scarce"
+
+
+@dataclasses.dataclass
+class _Waiter:
+    device: str
+    purpose: str
+    region: str
+    pool: tuple[str, str]
+    enqueued_at: float
+    last_seen: float
+    blocked_until: float = 0.0
+
+
+class AllocationScheduler:
+    """Orders devices competing for a scarce pool by weighted fair queuing over their purposes.
+
+    Devices compete within a pool - a region and the level range their purpose requires, like the coalesced availability
+    lookups - so a leveling device never waits behind IV devices short of leveled accounts. As long as nobody waits, devices
+    are admitted first-come-first-served. Once a device found no account it queues up and from then on only the first
+    `window` devices of the pool's fair order are admitted to search it. Everyone else is
+    told its queue position and when to come back, without touching the database. A device whose admitted search came up
+    empty is skipped for `retry_seconds` so devices with unmet level requirements don't block the head of the queue.
+
+    Purposes are served in proportion to their weight: the n-th waiter of a purpose is tagged with the purpose's virtual
+    finish time plus n / weight and the queue is ordered by tag. Region quotas cap the number of accounts the devices of a
+    region may hold at once.
+    """
+
+    def __init__(self, weights: dict[str, float], region_quotas: dict[str, int], window: int = 2, stale_seconds: float = 120,
+                 retry_seconds: tuple[int, int] = (5, 60)):
+        self.weights = weights
+        self.region_quotas = region_quotas
+        self.window = max(1, window)
+        self.stale_seconds = stale_seconds
+        self.retry_min, self.retry_max = retry_seconds
+        self._lock = threading.Lock()
+        self._waiters: dict[str, _Waiter] = {}
+        self._holders: dict[str, str] = {}
+        # keyed by pool (region, level requirement) respectively (pool, purpose)
+        self._virtual_finish: dict[tuple[tuple[str, str], str], float] = {}
+        self._virtual_time: dict[tuple[str, str], float] = {}
+        self._grant_interval: dict[tuple[str, str], float] = {}
+        self._last_grant: dict[tuple[str, str], float] = {}
+
+    def admit(self, device: str, purpose: str, region: Optional[str]) -> Optional[Queued]:
+        """Returns None if the device may search the pool now, otherwise its place in the queue."""
+        region = region or "shared"
+        pool = self._pool(region, purpose)
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            quota = self.region_quotas.get(region)
+            over_quota = quota is not None and sum(1 for d, r in self._holders.items() if r == region and d != device) >= quota
+
+            waiter = self._waiters.get(device)
+            if not waiter:
+                if not over_quota and not any(w.pool == pool for w in self._waiters.values()):
+                    return None
+                waiter = self._enqueue(device, purpose, region, now)
+            waiter.last_seen = now
+            if waiter.purpose != purpose or waiter.region != region:
+                self._waiters.pop(device)
+                waiter = self._enqueue(device, purpose, region, now)
+
+            order = self._fair_order(pool, now)
+            position = order.index(device) if device in order else len(order)
+            if over_quota:
+                return Queued(position + 1, None, self.retry_max, reason="quota")
+            if waiter.blocked_until > now:
+                return Queued(position + 1, None, self._clamp(waiter.blocked_until - now))
+            if position < self.window:
+                return None
+            eta = self._grant_interval.get(pool)
+            eta = eta * (position - self.window + 1) if eta else None
+            return Queued(position + 1, eta, self._clamp(eta if eta else self.retry_min))
+
+    def granted(self, device: str, purpose: str, region: Optional[str]):
+        region = region or "shared"
+        pool = self._pool(region, purpose)
+        now = time.monotonic()
+        with self._lock:
+            waiter = self._waiters.pop(device, None)
+            self._holders[device] = region
+            key = (pool, purpose)
+            start = self._virtual_finish.get(key, 0.0)
+            if not waiter:
+                # admitted without queueing, a queued purpose keeps the credit it built up while waiting
+                start = max(start, self._virtual_time.get(pool, 0.0))
+            finish = start + 1 / self._weight(purpose)
+            self._virtual_finish[key] = finish
+            self._virtual_time[pool] = max(self._virtual_time.get(pool, 0.0), start)
+            last = self._last_grant.get(pool)
+            if last is not None:
+                interval = now - last
+                previous = self._grant_interval.get(pool)
+                self._grant_interval[pool] = interval if previous is None else 0.8 * previous + 0.2 * interval
+            self._last_grant[pool] = now
+
+    def denied(self, device: str, purpose: str, region: Optional[str]):
+        """The device searched the pool without success - queue it and let others try first for a while."""
+        region = region or "shared"
+        now = time.monotonic()
+        with self._lock:
+            waiter = self._waiters.get(device) or self._enqueue(device, purpose, region, now)
+            waiter.last_seen = now
+            waiter.blocked_until = now + self.retry_min
+
+    def released(self, device: str):
+        with self._lock:
+            self._holders.pop(device, None)
+
+    def holders(self) -> dict[str, str]:
+        with self._lock:
+            return dict(self._holders)
+
+    def restore_holders(self, holders: dict[str, str]):
+        with self._lock:
+            self._holders.update(holders)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            result = {}
+            for region in {w.region for w in self._waiters.values()} | set(self._holders.values()):
+                result[region] = {
+                    "holders": sum(1 for r in self._holders.values() if r == region),
+                    "quota": self.region_quotas.get(region),
+                    "pools": {}
+                }
+            for pool in {w.pool for w in self._waiters.values()}:
+                result[pool[0]]["pools"][pool[1]] = {
+                    "grant_interval": self._grant_interval.get(pool),
+                    "queue": [{"device": device, "purpose": self._waiters[device].purpose, "waiting": int(now - self._waiters[device].enqueued_at)}
+                              for device in self._fair_order(pool, now, include_blocked=True)]
+                }
+            return result
+
+    def _enqueue(self, device: str, purpose: str, region: str, now: float) -> _Waiter:
+        pool = self._pool(region, purpose)
+        key = (pool, purpose)
+        if not any(w.pool == pool and w.purpose == purpose for w in self._waiters.values()):
+            # a purpose (re)joining the competition starts at the current virtual time instead of cashing in idle time
+            self._virtual_finish[key] = max(self._virtual_finish.get(key, 0.0), self._virtual_time.get(pool, 0.0))
+        waiter = _Waiter(device, purpose, region, pool, enqueued_at=now, last_seen=now)
+        self._waiters[device] = waiter
+        return waiter
+
+    def _fair_order(self, pool: tuple[str, str], now: float, include_blocked: bool = False) -> list[str]:
+        by_purpose: dict[str, list[_Waiter]] = {}
+        for waiter in sorted(self._waiters.values(), key=lambda w: w.enqueued_at):
+            if waiter.pool == pool and (include_blocked or waiter.blocked_until <= now):
+                by_purpose.setdefault(waiter.purpose, []).append(waiter)
+        tagged = []
+        for purpose, waiters in by_purpose.items():
+            start = self._virtual_finish.get((pool, purpose), 0.0)
+            weight = self._weight(purpose)
+            for i, waiter in enumerate(waiters):
+                tagged.append((start + (i + 1) / weight, waiter.enqueued_at, waiter.device))
+        return [device for (_, _, device) in sorted(tagged)]
+
+    def _prune(self, now: float):
+        stale = [device for device, waiter in self._waiters.items() if now - waiter.last_seen > self.stale_seconds]
+        for device in stale:
+            del self._waiters[device]
+
+    @staticmethod
+    def _pool(region: str, purpose: str) -> tuple[str, str]:
+        return region, purpose_level_query(purpose).strip(" ()")
+
+    def _weight(self, purpose: str) -> float:
+        return max(0.01, self.weights.get(purpose, 1.0))
+
+    def _clamp(self, seconds: float) -> int:
+        return int(min(self.retry_max, max(self.retry_min, seconds)))
@@ -1,47 +1,50 @@
 import datetime
+import functools
+import hashlib
 import json
 import logging
 import os
+import threading
 import time
 from typing import Optional
 from typing import Union
 
 import humanize as humanize
-from flask import Flask, request
+from flask import Flask, Response, g, request, stream_with_context
 from flask_basicauth import BasicAuth
 from loguru import logger
+from orjson import orjson
+from werkzeug.serving import is_running_from_reloader
 
+import export
+import profiling
+import snapshot
 from DatetimeWrapper import DatetimeWrapper
-from Location import Location
+from Location import Location, QUEST_WALK_SPEED_CALCULATED
 from config import Config
-from db_connection import DbConnection as Db
+from db_connection import DbConnection as Db, DatabaseUnavailable, clear_deadline, set_deadline, set_request_device
+from demand import DemandModel
+from forecast import EligibilityTimeline
+from health import health_update_query
+from jobs import PeriodicJob
 from logs import setup_logger
+from purposes import PURPOSE_LEVELS, purpose_level_query
+from reconciler import Reconciler
+from responses import ResourceVersions, encode, not_modified
+from rollup import HistoryRollup
+from scheduler import AllocationScheduler
+from single_flight import SingleFlight
 
 setup_logger()
 
 # TODO: add job to kill outdated assignments
 # SELECT username, FROM_UNIXTIME(last_updated), region  FROM `accounts` where FROM_UNIXTIME(last_updated) < '2023-06-07' and in_use_by IS NOT NULl
 
-# Speed can be 60 km/h up to distances of 3km
-QUEST_WALK_SPEED_CALCULATED = 16.67
-
 
 def _purpose_to_level_query(device_logger, purpose):
-    # IV_QUEST = "quest_iv"
-    # LEVEL = "level"
-    # QUEST = "quest"
-    # IV = "iv"
-    # MON_RAID = "mon_raid"
-
-    if purpose == "iv" or purpose == "quest" or purpose == "quest_iv":
-        return " (level >= 30)"
-    elif purpose == "mon_raid":
-        return " (level >= 8)"
-    elif purpose == "level":
-        return " (level < 30)"
-    else:
+    if purpose not in PURPOSE_LEVELS:
         device_logger.warning(f"Unhandled purpose {purpose}")
-        return " (1=1)"
+    return purpose_level_query(purpose)
 
 
 class AccountServer:
@@ -53,7 +56,29 @@ class AccountServer:
         self.port = self.config.listen_port
         self.resp_headers = {"Server": "pogoAccountServer", 'Content-Type': 'application/json'}
         self.app = None
+        self.availability_flight = SingleFlight(ttl_seconds=self.config.availability_cache_seconds)
+        # responses of mutating calls by Idempotency-Key. Server errors aren't kept so a retry runs again, neither are 204s
+        # (no account available, softban location) - running those again is harmless and a queued device gets a fresh position
+        self.idempotent_responses = SingleFlight(ttl_seconds=self.config.idempotency_ttl_seconds, max_entries=self.config.idempotency_max_entries,
+                                                 cache_if=lambda response: response[1] < 500 and response[1] != 204)
+        # last good responses, served while the database is unavailable
+        self.stats_cache = None
+        self.info_cache = {}
+        self.versions = ResourceVersions(max_age_seconds=self.config.etag_max_age_seconds)
+        self.history_rollup = HistoryRollup()
+        self.scheduler = AllocationScheduler(self.config.purpose_weights, self.config.region_quotas, window=self.config.scheduler_window)
+        self.demand = DemandModel()
+        self.timeline = EligibilityTimeline(self.config.cooldown_seconds, self.config.short_cooldown_seconds, self.config.account_max_logins_hour)
+        self.slow_requests = profiling.SlowRequestLog(self.config.slow_request_seconds)
+        self.profiler = profiling.SamplingProfiler()
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+        self.reconciler = Reconciler(batch_size=self.config.reconcile_batch_size, duty_cycle=self.config.reconcile_duty_cycle,
+                                     busy=lambda: self.in_flight > 0, on_released=self._reconciler_released)
+        self.jobs = []
+        self.snapshot = self._read_snapshot()
         self.load_accounts_from_file()
+        self.warm_started = self._warm_start()
         self.launch_server()
 
     def launch_server(self):
@@ -64,32 +89,119 @@ class AccountServer:
         self.app.config['BASIC_AUTH_FORCE'] = True
         self.app.config['MAX_CONTENT_LENGTH'] = 16 * 1000 * 1000
 
+        self.app.before_request(self._before_request)
+        self.app.after_request(self._after_request)
+        self.app.teardown_request(self._teardown_request)
+        self.app.register_error_handler(DatabaseUnavailable, self.database_unavailable)
+
         self.app.add_url_rule('/', "fallback", self.fallback, methods=['GET', 'POST'])
         self.app.add_url_rule('/<first>', "fallback", self.fallback, methods=['GET', 'POST'])
         self.app.add_url_rule('/<first>/<path:rest>', "fallback", self.fallback, methods=['GET', 'POST'])
 
         self.app.add_url_rule("/get/availability", "get_availability", self.get_availability, methods=['GET'])
-        self.app.add_url_rule("/get/<device>", "get_account", self.get_account, methods=['GET', 'POST'])
+        self.app.add_url_rule("/get/<device>", "get_account", self._idempotent(self.get_account), methods=['GET', 'POST'])
         self.app.add_url_rule("/get/<device>/info", "get_account_info", self.get_account_info, methods=['GET'])
-        self.app.add_url_rule("/set/<device>/level/<int:level>", "set_level", self.set_level, methods=['POST'])
-        self.app.add_url_rule("/set/<device>/burned", "set_burned", self.set_burned, methods=['POST'])
-        self.app.add_url_rule("/set/<device>/login", "set_login", self.track_login, methods=['POST'])
-        self.app.add_url_rule("/set/<device>/logout", "set_logout", self.set_logout, methods=['POST'])
-        self.app.add_url_rule("/set/<device>/softban", "set_softban", self.set_softban, methods=['POST'])
+        self.app.add_url_rule("/set/<device>/level/<int:level>", "set_level", self._idempotent(self.set_level), methods=['POST'])
+        self.app.add_url_rule("/set/<device>/burned", "set_burned", self._idempotent(self.set_burned), methods=['POST'])
+        self.app.add_url_rule("/set/<device>/login", "set_login", self._idempotent(self.track_login), methods=['POST'])
+        self.app.add_url_rule("/set/<device>/logout", "set_logout", self._idempotent(self.set_logout), methods=['POST'])
+        self.app.add_url_rule("/set/<device>/softban", "set_softban", self._idempotent(self.set_softban), methods=['POST'])
 
         self.app.add_url_rule("/stats", "stats", self.stats, methods=['GET'])
+        self.app.add_url_rule("/stats/history", "stats_history", self.stats_history, methods=['GET'])
+        self.app.add_url_rule("/stats/queue", "stats_queue", self.stats_queue, methods=['GET'])
+        self.app.add_url_rule("/stats/forecast", "stats_forecast", self.stats_forecast, methods=['GET'])
+        self.app.add_url_rule("/stats/selection", "stats_selection", self.stats_selection, methods=['GET'])
+        self.app.add_url_rule("/stats/reconciler", "stats_reconciler", self.stats_reconciler, methods=['GET'])
         self.app.add_url_rule("/test", "test", self.test, methods=['GET'])
+        self.app.add_url_rule("/export/<kind>", "export", self.export, methods=['GET'])
+        self.app.add_url_rule("/debug/profile", "debug_profile", self.debug_profile, methods=['GET'])
+        self.app.add_url_rule("/debug/slow", "debug_slow", self.debug_slow, methods=['GET'])
 
         werkzeug_logger = logging.getLogger("werkzeug")
         werkzeug_logger.setLevel(logging.WARNING)
+        self.start_background_jobs()
         logger.info(f"start listening on port {self.port}")
         self.app.run(host=self.host, port=self.port, debug=False, use_reloader=True)
 
+    def start_background_jobs(self):
+        # with the reloader the serving app runs in a child process, the parent only watches for file changes
+        if not is_running_from_reloader():
+            return
+        if self.config.rollup_interval_seconds > 0:
+            self.jobs.append(PeriodicJob("rollup", self.config.rollup_interval_seconds, self.history_rollup.update))
+        if self.config.encounter_aware_purposes and self.config.demand_refresh_seconds > 0:
+            self.jobs.append(PeriodicJob("demand", self.config.demand_refresh_seconds, self.demand.load))
+        if self.config.reconcile_interval_seconds > 0:
+            self.jobs.append(PeriodicJob("reconciler", self.config.reconcile_interval_seconds, self.reconciler.run,
+                                         first_run_after=self.config.reconcile_interval_seconds))
+        # a warm start already brought the timeline up to date
+        self.jobs.append(PeriodicJob("forecast", self.config.forecast_resync_seconds, self.timeline.resync,
+                                     first_run_after=self.config.forecast_resync_seconds if self.warm_started else 0))
+        if self.config.snapshot_file and self.config.snapshot_interval_seconds > 0:
+            self.jobs.append(PeriodicJob("snapshot", self.config.snapshot_interval_seconds, self.write_snapshot,
+                                         first_run_after=self.config.snapshot_interval_seconds))
+        for job in self.jobs:
+            job.start()
+
+    def _read_snapshot(self) -> Optional[tuple[dict, dict]]:
+        if not self.config.snapshot_file:
+            return None
+        try:
+            sections = snapshot.read_snapshot(self.config.snapshot_file)
+            if sections:
+                return orjson.loads(sections["meta"]), sections
+        except Exception as ex:
+            logger.warning(f"Unable to read snapshot {self.config.snapshot_file}: {ex}")
+        return None
+
+    def _warm_start(self) -> bool:
+        if not self.snapshot:
+            return False
+        meta, sections = self.snapshot
+        try:
+            if self.accounts_imported:
+                # imported rows keep last_updated and aren't seen by catch_up, the timeline is rebuilt right away instead
+                self.timeline.resync()
+                changed = "all"
+            else:
+                self.timeline.restore_state(sections)
+                changed = self.timeline.catch_up(meta["last_updated"], meta["history_id"])
+            # devices that returned or lost their account since the snapshot no longer count against the region quotas
+            holding = self.timeline.holders()
+            self.scheduler.restore_holders({device: region for device, region in meta["holders"].items() if device in holding})
+        except Exception as ex:
+            logger.warning(f"Unable to warm start from snapshot, rebuilding state: {ex}")
+            return False
+        logger.info(f"Warm started from snapshot of {humanize.naturaltime(time.time() - meta['created'])}, caught up on {changed} changed accounts")
+        return True
+
+    def write_snapshot(self):
+        # watermarks are taken before the state, changes in between are applied twice on catch up rather than lost
+        history_id, last_updated = Db.get_single_results("SELECT COALESCE(MAX(id), 0) FROM accounts_history", "SELECT COALESCE(MAX(last_updated), 0) FROM accounts")
+        sections = self.timeline.export_state()
+        sections["meta"] = orjson.dumps({
+            "created": time.time(),
+            "history_id": int(history_id),
+            "last_updated": int(last_updated),
+            "accounts_file": self.accounts_file_digest,
+            "holders": self.scheduler.holders()
+        })
+        snapshot.write_snapshot(self.config.snapshot_file, sections)
+        logger.debug(f"Wrote snapshot {self.config.snapshot_file}")
+
     def load_accounts_from_file(self, file="accounts.txt"):
         accounts = []
+        self.accounts_file_digest = None
+        self.accounts_imported = False
         if not os.path.isfile(file):
             logger.warning(f"{file} not found - not adding accounts")
             return False
+        with open(file, "rb") as f:
+            self.accounts_file_digest = hashlib.sha1(f.read()).hexdigest()
+        if self.snapshot and self.snapshot[0].get("accounts_file") == self.accounts_file_digest:
+            logger.info(f"{file} unchanged since the last snapshot - skipping import")
+            return True
         with open(file, "r") as f:
             for line in f:
                 try:
@@ -108,17 +220,19 @@ class AccountServer:
         with Db() as conn:
             conn.cur.executemany(sql, accounts)
             conn.conn.commit()
+        self.accounts_imported = True
+        self.versions.changed()
         return True
 
-    def resp_ok(self, code=200, data=None):
+    def resp_ok(self, code=200, data=None, etag=None, headers=None):
         standard = {"status": "ok"}
         if data is None:
             data = standard
         if "status" not in data:
             data = {"status": "ok", "data": data}
         if not data == standard:
-            logger.debug(f"responding with {code}, data: {data}")
-        return data, code, self.resp_headers
+            logger.debug("responding with {}, data: {}", code, data)
+        return self._encode(data, code, headers={**self.resp_headers, **headers} if headers else None, etag=etag)
 
     def invalid_request(self, data=None, code=400, logging=True):
         wrapper_data = {"status": "fail"}
@@ -126,7 +240,77 @@ class AccountServer:
             wrapper_data["data"] = data
         if logging:
             logger.warning(f"responding with {code}, data: {wrapper_data}")
-        return wrapper_data, code, self.resp_headers
+        return self._encode(wrapper_data, code)
+
+    def database_unavailable(self, ex: DatabaseUnavailable):
+        logger.warning(f"Database unavailable: {ex}")
+        wrapper_data = {"status": "fail", "data": "Database unavailable"}
+        return self._encode(wrapper_data, 503, headers={**self.resp_headers, "Retry-After": str(ex.retry_after)})
+
+    def resp_stale(self, data, code=200):
+        return self._encode(data, code, headers={**self.resp_headers, "Warning": '110 - "Response is Stale"'})
+
+    def _encode(self, data, code, headers=None, etag=None):
+        return encode(data, code, headers or self.resp_headers, etag=etag, compress_min_bytes=self.config.compress_min_bytes)
+
+    def _idempotent(self, handler):
+        """Replays the response of a retried call carrying the same Idempotency-Key instead of running `handler` again.
+
+        A retry arriving while the original call is still running waits for and shares its response.
+        """
+
+        @functools.wraps(handler)
+        def wrapper(**kwargs):
+            key = request.headers.get("Idempotency-Key")
+            if not key or self.config.idempotency_ttl_seconds <= 0:
+                return handler(**kwargs)
+            executed = []
+            response = self.idempotent_responses.do((request.endpoint, kwargs.get("device"), key),
+                                                    lambda: executed.append(True) or handler(**kwargs))
+            if executed:
+                return response
+            logger.bind(name=kwargs.get("device", "")).info("Replaying response of {} for Idempotency-Key {}", request.endpoint, key)
+            body, code, headers = response
+            return body, code, {**headers, "Idempotent-Replayed": "true"}
+
+        return wrapper
+
+    def _reconciler_released(self, device: str, username: str):
+        self.versions.changed(device)
+        self.timeline.released(username)
+
+    def _before_request(self):
+        # hooks registered before this one (basic auth) may answer the request, teardown still runs for it
+        g.counted_in_flight = True
+        with self.in_flight_lock:
+            self.in_flight += 1
+        # exports stream for longer than a request deadline, every batch gets its own
+        if request.endpoint != "export":
+            set_deadline(self.config.request_deadline_seconds)
+        set_request_device((request.view_args or {}).get("device") or request.args.get("device"))
+        # long running by design
+        if request.endpoint not in ("debug_profile", "export"):
+            profiling.start_trace(request.endpoint)
+
+    def _after_request(self, response):
+        trace = profiling.current_trace()
+        if trace:
+            trace.status = response.status_code
+        return response
+
+    def _teardown_request(self, exc=None):
+        if g.pop("counted_in_flight", False):
+            with self.in_flight_lock:
+                self.in_flight -= 1
+        clear_deadline()
+        set_request_device(None)
+        trace = profiling.end_trace()
+        if trace:
+            slow = self.slow_requests.add(trace)
+            if slow:
+                logger.bind(name=request.view_args.get("device", "") if request.view_args else "").warning(
+                    "Slow request {} took {}ms ({}ms in {} statements, {})", slow["handler"], slow["duration_ms"], slow["db_ms"],
+                    len(slow["statements"]), slow["counters"])
 
     def fallback(self, first=None, rest=None):
         logger.info("Fallback called")
@@ -141,9 +325,12 @@ class AccountServer:
         purpose = request.args.get('purpose', default='', type=str)
         region = request.args.get('region', default='', type=str)
         do_log = request.args.get('logging', default=0, type=int)
+        # rejected before joining the shared pool lookup, the reuse and login limit checks need a device
+        if not device:
+            return self.invalid_request(data="Missing 'device' parameter")
 
         device_logger = logger.bind(name=device)
-        device_logger.debug(f"get_availability({device}): purpose={purpose}, region={region}")
+        device_logger.debug("get_availability({}): purpose={}, region={}", device, purpose, region)
 
         last_returned_limit = self.config.get_cooldown_timestamp()
         last_returned_query = f"(last_returned IS NULL OR last_returned < {last_returned_limit} OR last_reason IS NULL)"
@@ -153,16 +340,24 @@ class AccountServer:
         try:
             if do_log:
                 logger.info(select_reuse)
-            resp = Db.get_single_results(select_reuse)
+            resp = Db.get_single_results(select_reuse, read_only=True)
             if resp[0]:
                 # we can reuse the account
                 return self.resp_ok(data={"available": int(resp[0]), "type": "reuse"})
+        except DatabaseUnavailable:
+            raise
         except Exception as ex:
             logger.exception(ex)
             logger.warning(f"Error during query: {select_reuse}")
             return self.invalid_request(code=500)
 
-        account = self._get_next_account(device=device, region=region, purpose=purpose, scan_location=None, do_log=do_log, reserve=False)
+        if self._device_login_limit_reached(device, device_logger, read_only=True):
+            return self.resp_ok(data={"available": 0, "type": "pool"})
+
+        # devices of the same purpose and region share one pool lookup (e.g. everyone probing after a MAD restart)
+        flight_key = (region, purpose_query)
+        account = self.availability_flight.do(flight_key, lambda: self._get_next_account(device=device, region=region, purpose=purpose, scan_location=None,
+                                                                                             do_log=do_log, reserve=False, check_device_limit=False))
         available = 1 if account else 0
 
         return self.resp_ok(data={"available": available, "type": "pool"})
@@ -171,7 +366,12 @@ class AccountServer:
         if not device:
             return self.invalid_request(data="Missing 'device' parameter")
         device_logger = logger.bind(name=device)
-        device_logger.debug(f"get_account_info()")
+        device_logger.debug("get_account_info()")
+
+        etag = self.versions.device_etag(device)
+        unchanged = not_modified(etag, self.resp_headers)
+        if unchanged:
+            return unchanged
 
         encounters_from = DatetimeWrapper.now() - datetime.timedelta(hours=self.config.cooldown_hours)
         select = (f"SELECT a.username, '***', a.level, a.last_returned, a.last_reason, COALESCE(ah.total, 0), a.softban_time, a.softban_location "
@@ -185,7 +385,8 @@ class AccountServer:
 
         try:
             data = None
-            with Db() as conn:
+            # a replica may not have the change behind a new ETag yet, which clients would then cache under it
+            with Db(read_only=not self.versions.changed_within(Db.router.max_lag_seconds, device)) as conn:
                 cursor = conn.cursor(buffered=True)
                 cursor.execute(select)
                 elem = cursor.fetchone()
@@ -203,12 +404,19 @@ class AccountServer:
                     reason_response = cursor.fetchone()
                     if reason_response:
                         data['last_reason'] = reason_response[0]
+        except DatabaseUnavailable:
+            if device in self.info_cache:
+                device_logger.warning("Database unavailable, serving cached info")
+                return self.resp_stale({"status": "ok", "data": self.info_cache[device]})
+            raise
         except Exception as ex:
             logger.exception(ex)
             logger.warning(f"Error during query: {select}")
             return self.invalid_request(code=500)
         if data:
-            return self.resp_ok(data=data)
+            self.info_cache[device] = data
+            return self.resp_ok(data=data, etag=etag)
+        self.info_cache.pop(device, None)
         return self.resp_ok(code=204)
 
     def get_account(self, device=None):
@@ -252,9 +460,7 @@ class AccountServer:
 
         if location:
             location = json.dumps(location)
-        device_logger.debug(
-            f"get_account: purpose={purpose}, region={region}, reason={reason}, "
-            f"location={location}, purpose={purpose}")
+        device_logger.debug("get_account: purpose={}, region={}, reason={}, location={}", purpose, region, reason, location)
 
         account = None
 
@@ -293,6 +499,8 @@ class AccountServer:
                         self._mark_account_used(username, device, purpose, cursor)
 
                         account = (username, pw, level, encounters, softban_info)
+                except DatabaseUnavailable:
+                    raise
                 except Exception as ex:
                     device_logger.error("Exception during query {}. Exception: {}", select, ex)
                 finally:
@@ -309,23 +517,42 @@ class AccountServer:
                 conn.cur.execute(reset)
                 if conn.cur.rowcount > 0:
                     device_logger.info(f"Reset 'accounts' for device as previous entry was still active.")
+                    self.versions.changed(device)
                 conn.cur.execute(reset_history)
                 if conn.cur.rowcount > 0:
                     device_logger.info(f"Reset 'accounts_history' for device as previous entry was still active.")
                 updated += conn.cur.rowcount
-
-            account = self._get_next_account(device=device, region=region, purpose=purpose, scan_location=location, do_log=do_log)
+            self.scheduler.released(device)
+            self.timeline.reset(device)
+
+            queued = self.scheduler.admit(device, purpose, region)
+            if queued:
+                device_logger.debug("Queued at position {} ({}), retry in {}s", queued.position, queued.reason, queued.retry_after)
+                # a 204 carries no body, the queue state is only in the headers
+                headers = {"Retry-After": str(queued.retry_after), "X-Queue-Position": str(queued.position), "X-Queue-Reason": queued.reason}
+                if queued.eta_seconds is not None:
+                    headers["X-Queue-ETA"] = str(int(queued.eta_seconds))
+                return self.resp_ok(code=204, headers=headers)
+
+            demand = self._selection_demand(device, purpose)
+            account = self._get_next_account(device=device, region=region, purpose=purpose, scan_location=location, do_log=do_log,
+                                             demand=demand)
 
             if not account:
-                device_logger.debug(f"Found no suitable account")
-                return self.resp_ok(code=204, data={"error": "No accounts available"})
+                device_logger.debug("Found no suitable account")
+                self.scheduler.denied(device, purpose, region)
+                return self.resp_ok(code=204, headers={"Retry-After": str(self.scheduler.retry_min)}, data={"error": "No accounts available"})
+            self.scheduler.granted(device, purpose, region)
+            # only fresh claims start a session, a reused account continues the device's current one. Without an estimate
+            # the selection fell back to last_use ordering
+            self.demand.session_started(device, purpose, "encounter_aware" if demand else "last_use", reason)
 
         # device_logger.debug(f"get_account(reason={reason}) returns: user {account[0]}, encounters {account[3]} ")
 
         self._write_history(username=account[0], device=device, acquired=DatetimeWrapper.now(), new_reason=reason, purpose=purpose)
 
         data = self._build_account_response(account=account, last_returned=None, last_reason=None, is_burnt=0)
-        device_logger.info("get_account: " + str(data))
+        device_logger.info("get_account: {} (level {}, remaining encounters {})", data["username"], data["level"], data["remaining_encounters"])
         return self.resp_ok(data=data)
 
     def set_level(self, device=None, level: int = None):
@@ -342,6 +569,7 @@ class AccountServer:
         update = (f"UPDATE accounts SET level = {level}, last_updated = '{int(time.time())}' WHERE in_use_by = '{device}';")
         with Db() as conn:
             conn.cur.execute(update)
+        self.versions.changed(device)
 
         return self.resp_ok()
 
@@ -355,6 +583,7 @@ class AccountServer:
                         f" softban_location = '{args['location']}' WHERE in_use_by = '{device}';")
         with Db() as conn:
             conn.cur.execute(set_location)
+        self.versions.changed(device)
 
         device_logger.debug(args)
         return self.resp_ok(code=204)
@@ -416,6 +645,10 @@ class AccountServer:
         try:
             with Db() as conn:
                 conn.cur.execute(reset)
+            self.versions.changed(device)
+            self.scheduler.released(device)
+            self.timeline.returned(device, burned=False, level=level)
+            self.demand.session_ended(device, encounters)
         except Exception as ex:
             logger.warning(f"Exception in {reset}: {ex}")
 
@@ -460,10 +693,14 @@ class AccountServer:
 
         with Db() as conn:
             conn.cur.execute(reset)
+        self.versions.changed(device)
+        self.scheduler.released(device)
+        self.timeline.returned(device, burned=bool(reason), level=level)
 
         encounters = None
         if 'encounters' in args:
             encounters = int(args['encounters'])
+        self.demand.session_ended(device, encounters)
         self._write_history(username, device, new_reason=reason, encounters=encounters, returned=DatetimeWrapper.now())
 
         return self.resp_ok(data={"username": username, "status": "burned"})
@@ -484,6 +721,7 @@ class AccountServer:
             new_history_before = DatetimeWrapper.now() - datetime.timedelta(days=5)
             find_candidate_query = f"SELECT id, reason, encounters from accounts_history WHERE device = '{device}' AND username = '{username}' AND returned IS NULL AND acquired > '{new_history_before}' ORDER BY ID desc LIMIT 1 FOR UPDATE;"
             history_query = None
+            final_reason = new_reason
             try:
                 updating = False
                 cursor.execute(find_candidate_query)
@@ -492,6 +730,7 @@ class AccountServer:
                     old_reason = elem[1] if elem[1] else None
                     if old_reason and old_reason == 'prelogin' and new_reason == 'logout' and encounters and encounters == 0:
                         reason_sql = f", reason = 'nologin'"
+                        final_reason = 'nologin'
                     old_encounters = int(elem[2]) if elem[2] else None
                     if old_encounters and encounters and old_encounters > encounters > 0:
                         logger.warning(f"old_encounters {old_encounters} > encounters {encounters}. Incrementing.")
@@ -508,14 +747,18 @@ class AccountServer:
                     history_query = (
                         f"INSERT INTO accounts_history SET username = '{username}', device = '{device}' {acquired_sql} {returned_sql} {reason_sql} {encounters_sql} {purpose_sql}")
                 if history_query:
-                    device_logger.info(f"History: {history_query}")
+                    device_logger.debug("History: {}", history_query)
                     cursor.execute(history_query)
+                    self.versions.changed(device)
+                health_query = health_update_query(username, final_reason) if returned else None
+                if health_query:
+                    cursor.execute(health_query)
             except Exception as ex:
                 device_logger.info(f"Unable to write history. Query: {find_candidate_query} / {history_query}: {ex}")
             finally:
                 cursor.close()
 
-    def _stats_data(self):
+    def _stats_data(self, read_only: bool = True):
         last_returned_limit = self.config.get_cooldown_timestamp()
         last_returned_query = f"(last_returned IS NULL OR last_returned < {last_returned_limit} OR last_reason IS NULL)"
 
@@ -537,9 +780,9 @@ class AccountServer:
             total_sql = f"SELECT count(*) FROM accounts WHERE {region_query}"
 
             in_use, unleveled, total, a_leveled, a_unleveled = Db.get_single_results(in_use_sql, unleveled_sql, total_sql, available_leveled_sql,
-                                                                                     available_unleveled_sql)
+                                                                                     available_unleveled_sql, read_only=read_only)
             cooldown = {}
-            with Db() as conn:
+            with Db(read_only=read_only) as conn:
                 cursor = conn.cursor()
                 cd_sql = f"SELECT COALESCE(last_reason, 'unknown'), count(*) FROM accounts WHERE last_returned >= {last_returned_limit} AND {region_query} GROUP BY last_reason"
                 try:
@@ -547,15 +790,33 @@ class AccountServer:
                     res = cursor.fetchall()
                     for (reason, count) in res:
                         cooldown[reason] = int(count)
+                except DatabaseUnavailable:
+                    raise
                 except:
                     pass
 
+            health = {}
+            if self.config.health_bucket > 0:
+                with Db(read_only=read_only) as conn:
+                    cursor = conn.cursor()
+                    bucket = self.config.health_bucket
+                    health_sql = f"SELECT LEAST(health, 99) DIV {bucket} * {bucket}, count(*) FROM accounts WHERE {region_query} GROUP BY 1 ORDER BY 1"
+                    try:
+                        cursor.execute(health_sql)
+                        for (lower, count) in cursor.fetchall():
+                            health[f"{int(lower)}-{100 if int(lower) + bucket > 99 else int(lower) + bucket - 1}"] = int(count)
+                    except DatabaseUnavailable:
+                        raise
+                    except:
+                        pass
+
             result[region] = {
                 "total": {
                     "accounts": total,
                     "in_use": in_use,
                     "cooldown": cooldown,
-                    "unleveled": unleveled
+                    "unleveled": unleveled,
+                    "health": health
                 },
                 "available": {
                     "total": a_leveled + a_unleveled,
@@ -574,7 +835,7 @@ class AccountServer:
         lng = request.args.get('lng', default=0.0, type=float)
 
         account = self._get_next_account(device=device, region=region, purpose=purpose, scan_location=Location(lat, lng).to_json(), do_log=True, reserve=False)
-        logger.info(account)
+        logger.info("test: {}", account[0] if account else None)
         if account and account[4]:
             softban_info = account[4]
             last_action_location = Location.from_json(softban_info[1])
@@ -586,7 +847,8 @@ class AccountServer:
             # logger.info(f"Cooldown: {cooldown_seconds}")
             usable = DatetimeWrapper.now() > softban_time + datetime.timedelta(seconds=cooldown_seconds)
             logger.info(f"Usable: {usable}")
-            return self.resp_ok(data=account)
+            # the response dict, unlike the account tuple, gets its password redacted in the debug log
+            return self.resp_ok(data=self._build_account_response(account=account, last_returned=None, last_reason=None))
         return self.resp_ok(code=204)
 
     # TODO: add
@@ -610,7 +872,86 @@ class AccountServer:
     #         return usable
 
     def stats(self):
-        return self._stats_data(), 200, self.resp_headers
+        etag = self.versions.pool_etag()
+        unchanged = not_modified(etag, self.resp_headers)
+        if unchanged:
+            return unchanged
+        try:
+            # a replica may not have the change behind a new ETag yet, which clients would then cache under it
+            self.stats_cache = self._stats_data(read_only=not self.versions.changed_within(Db.router.max_lag_seconds))
+        except DatabaseUnavailable:
+            if self.stats_cache is None:
+                raise
+            logger.warning("Database unavailable, serving cached stats")
+            return self.resp_stale(self.stats_cache)
+        return self._encode(self.stats_cache, 200, etag=etag)
+
+    def export(self, kind=None):
+        if kind not in export.EXPORTS:
+            return self.invalid_request(data=f"Unknown export '{kind}', use one of {', '.join(export.EXPORTS)}")
+        fmt = request.args.get('format', default='ndjson', type=str)
+        if fmt not in ("ndjson", "csv"):
+            return self.invalid_request(data="'format' has to be 'ndjson' or 'csv'")
+        try:
+            time_from = export.parse_time(request.args.get('from', default=None, type=str))
+            time_to = export.parse_time(request.args.get('to', default=None, type=str))
+        except ValueError as ex:
+            return self.invalid_request(data=f"Invalid time range: {ex}")
+        after_id = request.args.get('after_id', default=0, type=int)
+        region = request.args.get('region', default=None, type=str)
+        limit = request.args.get('limit', default=0, type=int)
+        logger.info(f"Exporting {kind} as {fmt} (after_id={after_id}, region={region}, from={time_from}, to={time_to}, limit={limit})")
+
+        # the first batch runs before streaming starts, a DatabaseUnavailable still becomes a 503 with Retry-After
+        rows = export.started(export.export_rows(kind, after_id=after_id, region=region, time_from=time_from, time_to=time_to, limit=limit,
+                                                 batch_size=self.config.export_batch_size, batch_seconds=self.config.request_deadline_seconds))
+        if fmt == "csv":
+            return Response(stream_with_context(export.csv_lines(kind, rows)), mimetype="text/csv", headers={"Server": self.resp_headers["Server"]})
+        return Response(stream_with_context(export.ndjson_lines(kind, rows)), mimetype="application/x-ndjson", headers={"Server": self.resp_headers["Server"]})
+
+    def debug_profile(self):
+        seconds = min(60.0, max(0.1, request.args.get('seconds', default=10.0, type=float)))
+        logger.info(f"Profiling for {seconds}s")
+        folded = self.profiler.profile(seconds)
+        if folded is None:
+            return self.invalid_request(data="Profiling already in progress", code=409)
+        return Response(folded, mimetype="text/plain", headers={"Server": self.resp_headers["Server"]})
+
+    def debug_slow(self):
+        return self._encode(self.slow_requests.entries(), 200)
+
+    def stats_forecast(self):
+        region = request.args.get('region', default=None, type=str)
+        bucket_seconds = max(60, request.args.get('bucket_minutes', default=60, type=int) * 60)
+        horizon_seconds = request.args.get('hours', default=self.config.cooldown_hours, type=int) * 3600
+        now = time.time()
+
+        forecast = self.timeline.histogram(bucket_seconds, horizon_seconds, now=now)
+        if region:
+            forecast = {region: forecast.get(region, {})}
+        return self._encode({"now": int(now), "bucket_seconds": bucket_seconds, "regions": forecast}, 200)
+
+    def stats_selection(self):
+        return self._encode({"encounter_aware_purposes": self.config.encounter_aware_purposes, "purposes": self.demand.metrics()}, 200)
+
+    def stats_reconciler(self):
+        return self._encode(self.reconciler.report(), 200)
+
+    def stats_queue(self):
+        return self._encode(self.scheduler.stats(), 200)
+
+    def stats_history(self):
+        try:
+            time_to = export.parse_time(request.args.get('to', default=None, type=str)) or DatetimeWrapper.now()
+            time_from = export.parse_time(request.args.get('from', default=None, type=str)) or time_to - datetime.timedelta(days=1)
+        except ValueError as ex:
+            return self.invalid_request(data=f"Invalid time range: {ex}")
+        region = request.args.get('region', default=None, type=str)
+        purpose = request.args.get('purpose', default=None, type=str)
+        reason = request.args.get('reason', default=None, type=str)
+
+        rows = self.history_rollup.query(time_from, time_to, region=region, purpose=purpose, reason=reason)
+        return self._encode({"from": time_from, "to": time_to, "rows": rows}, 200)
 
     def _build_account_response(self, account: tuple[str, str, int, int, tuple[str, str]], last_returned: Optional[int], last_reason: Optional[str], is_burnt: int = 0):
         remaining_encounters = max(0, self.config.encounter_limit - account[3])
@@ -629,49 +970,76 @@ class AccountServer:
         logger.debug(response)
         return response
 
-    def _get_next_account(self, device: str, region: str, purpose: str, scan_location: Optional[Union[bytes, str]], do_log: int, reserve: bool = True) -> Optional[
-        tuple[str, str, int, int, tuple[str, str]]]:
-        if not device:
-            return None
-        device_logger = logger.bind(name=device)
-
+    def _device_login_limit_reached(self, device: str, device_logger, read_only: bool = False) -> bool:
         # throttle device logins attempts per hour
         device_logins = (f"   SELECT COUNT(*) device_logins FROM accounts_history"
                          f"    WHERE acquired > '{DatetimeWrapper.now() - datetime.timedelta(hours=1)}'"
                          f"      AND device = '{device}'"
                          f"    LIMIT 1")
-        with Db() as conn:
+        with Db(read_only=read_only) as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute(device_logins)
                 elem = cursor.fetchone()
                 if elem and int(elem[0]) > self.config.device_max_logins_hour:
                     device_logger.warning(f"Device reached {int(elem[0])}/{self.config.device_max_logins_hour} new account assignments during the last hour. Cooling down.")
-                    return None
+                    return True
             except Exception as ex:
                 device_logger.warning(f"Unable to check for device logins. Query: {device_logins}: {ex}")
-                pass
+        return False
+
+    def _selection_demand(self, device: str, purpose: str) -> Optional[tuple[int, int]]:
+        if purpose not in self.config.encounter_aware_purposes:
+            return None
+        return self.demand.expected(device, purpose)
+
+    def _get_next_account(self, device: str, region: str, purpose: str, scan_location: Optional[Union[bytes, str]], do_log: int, reserve: bool = True,
+                          check_device_limit: bool = True, demand: Optional[tuple[int, int]] = None) -> Optional[tuple[str, str, int, int, tuple[str, str]]]:
+        if not device:
+            return None
+        device_logger = logger.bind(name=device)
+
+        if check_device_limit and self._device_login_limit_reached(device, device_logger):
+            return None
 
         # reuse account
         region_query = f" (region IS NULL OR region = '' OR region = '{region}')" if region else " 1=1 "
 
         last_returned_query = f"(last_returned IS NULL OR last_returned < {self.config.get_cooldown_timestamp()} OR last_reason IS NULL)"
-        order_by_query = "ORDER BY a.level DESC, a.last_use ASC" if purpose == 'level' else "ORDER BY a.region IS NULL, a.last_use ASC"
+        # healthy accounts first, in buckets so accounts within a bucket still rotate by last use
+        health_order = f"LEAST(a.health, 99) DIV {self.config.health_bucket} DESC, " if self.config.health_bucket > 0 else ""
+        order_by_query = f"ORDER BY a.level DESC, {health_order}a.last_use ASC" if purpose == 'level' else f"ORDER BY a.region IS NULL, {health_order}a.last_use ASC"
 
         purpose_level_requirement = _purpose_to_level_query(device_logger, purpose)
         count_encounters_from = DatetimeWrapper.now() - datetime.timedelta(hours=self.config.cooldown_hours)
 
+        if demand:
+            # encounter aware: prefer accounts whose remaining encounters, plus those aging out of the window during the expected
+            # session, cover the expected demand - otherwise the one with the most capacity
+            demand_encounters, demand_seconds = demand
+            aging_before = count_encounters_from + datetime.timedelta(seconds=demand_seconds)
+            encounters_query = (f"SELECT username, SUM(encounters) total, SUM(CASE WHEN returned < '{aging_before}' THEN encounters ELSE 0 END) aging"
+                                f"  FROM accounts_history ah"
+                                f" WHERE returned > '{count_encounters_from}' "
+                                f" GROUP BY username")
+            encounters_requirement = f"COALESCE(ah.total, 0) < {self.config.encounter_limit * 0.8}"
+            capacity = f"{self.config.encounter_limit} - COALESCE(ah.total, 0) + COALESCE(ah.aging, 0)"
+            order_by_query = (f"ORDER BY {capacity} >= {demand_encounters} DESC, CASE WHEN {capacity} >= {demand_encounters} THEN 0 ELSE {capacity} END DESC, "
+                              f"{order_by_query[len('ORDER BY '):]}")
+        else:
+            encounters_query = (f"SELECT username, SUM(encounters) total FROM accounts_history ah"
+                                f"  WHERE returned > '{count_encounters_from}' "
+                                f"  GROUP BY username"
+                                f"  HAVING SUM(encounters) < {self.config.encounter_limit * 0.8}")  # at least 20% of encounters left to prevent frequent relogins
+            encounters_requirement = "1=1"
+
         account = None
         ignore_accounts = list()
         while not account and len(ignore_accounts) < 20:
             username_exclusion = f"AND a.username NOT IN ({','.join(ignore_accounts)})" if len(ignore_accounts) > 0 else ""
             select = (f"SELECT a.username, a.password, a.level, COALESCE(ah.total, 0), a.softban_time, a.softban_location "
                       f"  FROM accounts a LEFT JOIN "
-                      f"       (SELECT username, SUM(encounters) total FROM accounts_history ah"
-                      f"         WHERE returned > '{count_encounters_from}' "
-                      f"      GROUP BY username"
-                      f"        HAVING SUM(encounters) < {self.config.encounter_limit * 0.8}"  # at least 20% of encounters left to prevent frequent relogins 
-                      f"       ) ah ON a.username = ah.username"
+                      f"       ({encounters_query}) ah ON a.username = ah.username"
                       f"                  LEFT JOIN"
                       f"      (SELECT username, COUNT(*) user_logins FROM accounts_history bh"
                       f"        WHERE acquired > '{DatetimeWrapper.now() - datetime.timedelta(hours=1)}'"
@@ -681,6 +1049,7 @@ class AccountServer:
                       f"   AND {last_returned_query}"
                       f"   AND (last_use < {self.config.get_short_cooldown_timestamp()} OR level < 30)"
                       f"   AND {purpose_level_requirement}"
+                      f"   AND {encounters_requirement}"
                       f"   AND {region_query}"
                       f"   AND COALESCE(bh.user_logins, 0) <= {self.config.account_max_logins_hour}"  # limit login attempts per account to 4/hour
                       f"   {username_exclusion}"
@@ -691,7 +1060,7 @@ class AccountServer:
                 device_logger.info(select)
             else:
                 device_logger.debug(select)
-            with Db() as conn:
+            with Db(read_only=not reserve) as conn:
                 cursor = conn.cursor()
                 try:
                     cursor.execute(select)
@@ -705,6 +1074,7 @@ class AccountServer:
 
                         if softban_info and scan_location and not self._account_suitable_for_location(device, softban_info, scan_location):
                             ignore_accounts.append(f"'{username}'")
+                            profiling.count("next_account_retries")
                             device_logger.info(f"Account '{username}' not suitable. Skipping")
                             continue
 
@@ -714,6 +1084,8 @@ class AccountServer:
                             self._mark_account_used(username, device, purpose, cursor)
 
                         account = (username, pw, level, encounters, softban_info)
+                except DatabaseUnavailable:
+                    raise
                 except Exception as ex:
                     logger.exception(ex)
                     logger.opt(exception=True).error("Exception during query {}. Exception: {}", select, ex)
@@ -734,7 +1106,7 @@ class AccountServer:
         softban_time = datetime.datetime.fromisoformat(softban_info[0])
         cooldown_seconds = Location.calculate_cooldown(distance_last_action, QUEST_WALK_SPEED_CALCULATED)
         usable = DatetimeWrapper.now() > softban_time + datetime.timedelta(seconds=cooldown_seconds)
-        device_logger.debug(f"Last Location: {last_action_location}, New Location: {scan_location}, Cooldown: {cooldown_seconds}, Usable: {usable}")
+        device_logger.debug("Last Location: {}, New Location: {}, Cooldown: {}, Usable: {}", last_action_location, scan_location, cooldown_seconds, usable)
         return usable
 
     def _mark_account_used(self, username, device, purpose, cursor):
@@ -742,6 +1114,8 @@ class AccountServer:
         mark_used = (f"UPDATE accounts SET in_use_by = '{device}', last_use = '{timestamp}', last_updated = '{timestamp}', last_reason = NULL,"
                      f"purpose = '{purpose}' WHERE username = '{username}';")
         cursor.execute(mark_used)
+        self.versions.changed(device)
+        self.timeline.claimed(username, device, now=timestamp)
 
 
 if __name__ == "__main__":
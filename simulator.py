@@ -0,0 +1,347 @@
+"""Offline capacity simulator for cooldown and login limit policies.
+
+Replays device demand against an in-memory account pool with the selection rules of `_get_next_account` and reports
+utilization, starvation and relogins per configuration, e.g.
+
+    python simulator.py --days 14 --accounts EU:300,shared:100 --devices EU:iv:40,EU:level:5 \\
+        --sweep cooldown_hours=12,24 cooldown_reuse_hours=1,3 encounter_limit=6500,8000
+"""
+import argparse
+import bisect
+import collections
+import dataclasses
+import heapq
+import itertools
+import multiprocessing
+import random
+import sys
+from typing import Optional
+
+from orjson import orjson
+
+from Location import Location, QUEST_WALK_SPEED_CALCULATED
+from config import Config
+from purposes import purpose_accepts_level
+
+HOUR = 3600
+# rough bounding boxes to place quest scans in, distances drive the softban cooldown
+REGION_CENTERS = {"EU": (50.0, 10.0), "US": (40.0, -95.0), "shared": (50.0, 10.0)}
+
+
+@dataclasses.dataclass(frozen=True)
+class Policy:
+    cooldown_hours: int = Config.cooldown_hours
+    cooldown_reuse_hours: int = Config.short_cooldown_hours
+    encounter_limit: int = Config.encounter_limit
+    device_max_logins_hour: int = Config.device_max_logins_hour
+    account_max_logins_hour: int = Config.account_max_logins_hour
+
+
+@dataclasses.dataclass(frozen=True)
+class DeviceProfile:
+    region: str
+    purpose: str
+    # encounters per hour while holding an account and mean hours until a maintenance screen burns the account
+    encounter_rate: float
+    hours_to_burn: float
+    # recorded demand: mean session length, sessions end for rotation after this long
+    session_hours: Optional[float] = None
+
+
+@dataclasses.dataclass
+class _Account:
+    index: int
+    region: Optional[str]
+    level: int
+    last_use: float = -1e9
+    last_returned: float = -1e9
+    burned: bool = False
+    in_use: bool = False
+    encounters: collections.deque = dataclasses.field(default_factory=collections.deque)
+    logins: collections.deque = dataclasses.field(default_factory=collections.deque)
+    softban: Optional[tuple[float, Location]] = None
+
+
+@dataclasses.dataclass
+class _Device:
+    name: str
+    profile: DeviceProfile
+    account: Optional[_Account] = None
+    logins: collections.deque = dataclasses.field(default_factory=collections.deque)
+    waiting_since: Optional[float] = None
+    location: Optional[Location] = None
+
+
+class Simulation:
+    """Discrete event simulation, events are (time, sequence, kind, device) tuples on a heap.
+
+    Whether a free account is past its cooldowns, login limit and encounter window doesn't depend on the device asking,
+    so it is computed once when the account is returned. Free accounts wait on a heap until then and only eligible ones are
+    kept in the orders of `_get_next_account`, a search just has to skip accounts of the wrong level or region.
+    """
+
+    def __init__(self, policy: Policy, accounts: list[tuple[Optional[str], int]], devices: list[DeviceProfile], seed: int = 0,
+                 retry_seconds: int = 60):
+        self.policy = policy
+        self.random = random.Random(seed)
+        self.retry_seconds = retry_seconds
+        self.accounts = [_Account(i, region, level) for i, (region, level) in enumerate(accounts)]
+        self.devices = [_Device(f"{profile.region}-{profile.purpose}-{i}", profile) for i, profile in enumerate(devices)]
+        # eligible free accounts in the orders used by _get_next_account, free accounts still cooling down by eligibility
+        self.by_last_use = sorted(self._key_default(account) for account in self.accounts)
+        self.by_level = sorted(self._key_level(account) for account in self.accounts)
+        self.cooling_down = []
+        self.events = []
+        self.sequence = itertools.count()
+        self.in_use_seconds = 0.0
+        self.starved_seconds = 0.0
+        self.claims = 0
+        self.relogins = 0
+        self.failed_polls = 0
+        self.burns = 0
+
+    def run(self, days: float) -> dict:
+        end = days * 24 * HOUR
+        for device in self.devices:
+            self._push(self.random.uniform(0, 300), "request", device)
+        while self.events and self.events[0][0] < end:
+            now, _, kind, device = heapq.heappop(self.events)
+            if kind == "request":
+                self._request(now, device)
+            else:
+                self._session_end(now, device, kind)
+        for device in self.devices:
+            if device.waiting_since is not None:
+                self.starved_seconds += end - device.waiting_since
+            if device.account:
+                self.in_use_seconds += end - device.account.last_use
+
+        hours = end / HOUR
+        return {
+            **dataclasses.asdict(self.policy),
+            "utilization": round(self.in_use_seconds / (len(self.accounts) * end), 4) if self.accounts else 0,
+            "starved_hours_per_device_day": round(self.starved_seconds / HOUR / max(1, len(self.devices)) / days, 3),
+            "relogins_per_hour": round(self.relogins / hours, 2),
+            "claims_per_hour": round(self.claims / hours, 2),
+            "failed_polls_per_hour": round(self.failed_polls / hours, 2),
+            "burns_per_hour": round(self.burns / hours, 2)
+        }
+
+    def _push(self, at: float, kind: str, device: _Device):
+        heapq.heappush(self.events, (at, next(self.sequence), kind, device))
+
+    def _request(self, now: float, device: _Device):
+        profile = device.profile
+        if profile.purpose in ("quest", "quest_iv"):
+            lat, lng = REGION_CENTERS.get(profile.region, REGION_CENTERS["shared"])
+            device.location = Location(lat + self.random.uniform(-0.5, 0.5), lng + self.random.uniform(-0.5, 0.5))
+
+        account = self._select(now, device)
+        if not account:
+            self.failed_polls += 1
+            if device.waiting_since is None:
+                device.waiting_since = now
+            self._push(now + self.retry_seconds, "request", device)
+            return
+
+        if device.waiting_since is not None:
+            self.starved_seconds += now - device.waiting_since
+            device.waiting_since = None
+        self._claim(now, device, account)
+
+        remaining = max(0.0, self.policy.encounter_limit - self._encounters(now, account))
+        ends = [(now + remaining / profile.encounter_rate * HOUR if profile.encounter_rate > 0 else float("inf"), "limit"),
+                (now + self.random.expovariate(1 / profile.hours_to_burn) * HOUR, "maintenance")]
+        if profile.session_hours:
+            ends.append((now + self.random.expovariate(1 / profile.session_hours) * HOUR, "rotation"))
+        at, reason = min(ends)
+        self._push(max(at, now + 60), reason, device)
+
+    def _session_end(self, now: float, device: _Device, reason: str):
+        account = device.account
+        device.account = None
+        account.in_use = False
+        account.last_returned = now
+        account.burned = reason == "maintenance"
+        self.burns += account.burned
+        # encounters ran out mid session, the device has to login with another account
+        self.relogins += reason == "limit"
+        account.encounters.append((now, device.profile.encounter_rate * (now - account.last_use) / HOUR))
+        if device.profile.purpose == "level" and account.level < 30:
+            account.level = min(30, account.level + max(1, int((now - account.last_use) / HOUR)))
+        if device.location:
+            account.softban = (now, device.location)
+        self.in_use_seconds += now - account.last_use
+        heapq.heappush(self.cooling_down, (self._eligible_from(now, account), account.index))
+        self._push(now, "request", device)
+
+    def _select(self, now: float, device: _Device) -> Optional[_Account]:
+        profile = device.profile
+        hour_ago = now - HOUR
+        while device.logins and device.logins[0] <= hour_ago:
+            device.logins.popleft()
+        if len(device.logins) > self.policy.device_max_logins_hour:
+            return None
+
+        while self.cooling_down and self.cooling_down[0][0] <= now:
+            account = self.accounts[heapq.heappop(self.cooling_down)[1]]
+            bisect.insort(self.by_last_use, self._key_default(account))
+            bisect.insort(self.by_level, self._key_level(account))
+
+        if profile.purpose == "level":
+            # leveled accounts sort first and never qualify
+            candidates = self.by_level[bisect.bisect_left(self.by_level, (-29,)):]
+        else:
+            candidates = self.by_last_use
+        skipped = 0
+        for key in candidates:
+            account = self.accounts[key[-1]]
+            if not purpose_accepts_level(profile.purpose, account.level) or (account.region and account.region != profile.region):
+                continue
+            if account.softban and device.location and not self._suitable_for_location(now, account, device.location):
+                # _get_next_account gives up after 20 unsuitable accounts
+                skipped += 1
+                if skipped >= 20:
+                    return None
+                continue
+            return account
+        return None
+
+    def _eligible_from(self, now: float, account: _Account) -> float:
+        """Time from which a returned account passes the cooldown, login limit and encounter conditions again."""
+        policy = self.policy
+        eligible_from = now
+        if account.burned:
+            eligible_from = account.last_returned + policy.cooldown_hours * HOUR
+        if account.level >= 30:
+            eligible_from = max(eligible_from, account.last_use + policy.cooldown_reuse_hours * HOUR)
+        while account.logins and account.logins[0] <= now - HOUR:
+            account.logins.popleft()
+        if len(account.logins) > policy.account_max_logins_hour:
+            eligible_from = max(eligible_from, account.logins[-policy.account_max_logins_hour - 1] + HOUR)
+        # at least 20% of encounters left to prevent frequent relogins
+        total = self._encounters(now, account)
+        for (returned, encounters) in account.encounters:
+            if total < policy.encounter_limit * 0.8:
+                break
+            total -= encounters
+            eligible_from = max(eligible_from, returned + policy.cooldown_hours * HOUR)
+        return eligible_from
+
+    def _encounters(self, now: float, account: _Account) -> float:
+        window_start = now - self.policy.cooldown_hours * HOUR
+        while account.encounters and account.encounters[0][0] <= window_start:
+            account.encounters.popleft()
+        return sum(count for (_, count) in account.encounters)
+
+    @staticmethod
+    def _suitable_for_location(now: float, account: _Account, location: Location) -> bool:
+        softban_time, last_location = account.softban
+        distance = last_location.get_distance_from_in_meters(location.lat, location.lng)
+        return now > softban_time + Location.calculate_cooldown(distance, QUEST_WALK_SPEED_CALCULATED)
+
+    def _claim(self, now: float, device: _Device, account: _Account):
+        self.by_last_use.remove(self._key_default(account))
+        self.by_level.remove(self._key_level(account))
+        account.in_use = True
+        account.last_use = now
+        account.burned = False
+        account.logins.append(now)
+        device.logins.append(now)
+        device.account = account
+        self.claims += 1
+
+    @staticmethod
+    def _key_default(account: _Account) -> tuple:
+        # ORDER BY a.region IS NULL, a.last_use ASC
+        return account.region is None, account.last_use, account.index
+
+    @staticmethod
+    def _key_level(account: _Account) -> tuple:
+        # ORDER BY a.level DESC, a.last_use ASC
+        return -account.level, account.last_use, account.index
+
+
+def _parse_accounts(value: str, unleveled: float) -> list[tuple[Optional[str], int]]:
+    accounts = []
+    for entry in value.split(","):
+        region, amount = entry.split(":")
+        region = None if region == "shared" else region
+        amount = int(amount)
+        leveled = amount - int(amount * unleveled)
+        accounts += [(region, 30)] * leveled + [(region, 1)] * (amount - leveled)
+    return accounts
+
+
+def _parse_devices(value: str, encounter_rate: float, hours_to_burn: float) -> list[DeviceProfile]:
+    devices = []
+    for entry in value.split(","):
+        region, purpose, amount = entry.split(":")
+        devices += [DeviceProfile(region, purpose, encounter_rate, hours_to_burn)] * int(amount)
+    return devices
+
+
+def load_recorded(days: int) -> tuple[list[tuple[Optional[str], int]], list[DeviceProfile]]:
+    """Builds the pool from `accounts` and one device profile per device/purpose from the last `days` of `accounts_history`."""
+    from db_connection import DbConnection as Db
+    with Db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT region, level FROM accounts")
+        accounts = [(region or None, int(level or 0)) for (region, level) in cursor.fetchall()]
+        cursor.execute(
+            "SELECT ah.device, COALESCE(ah.purpose, ''), COALESCE(MAX(a.region), 'shared'),"
+            "       SUM(ah.encounters) / GREATEST(SUM(TIMESTAMPDIFF(SECOND, ah.acquired, ah.returned)) / 3600, 1),"
+            "       AVG(TIMESTAMPDIFF(SECOND, ah.acquired, ah.returned)) / 3600,"
+            "       SUM(TIMESTAMPDIFF(SECOND, ah.acquired, ah.returned)) / 3600 / GREATEST(SUM(ah.reason = 'maintenance'), 1)"
+            "  FROM accounts_history ah LEFT JOIN accounts a ON a.username = ah.username"
+            " WHERE ah.acquired > NOW() - INTERVAL %s DAY AND ah.returned IS NOT NULL"
+            " GROUP BY ah.device, ah.purpose", (days,))
+        devices = [DeviceProfile(region, purpose, float(rate or 0), float(to_burn or 1), float(session or 1))
+                   for (_, purpose, region, rate, session, to_burn) in cursor.fetchall() if purpose]
+        cursor.close()
+    return accounts, devices
+
+
+def _simulate(job: tuple) -> dict:
+    policy, accounts, devices, days, seed = job
+    return Simulation(policy, accounts, devices, seed=seed).run(days)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate account pool capacity under alternative policies")
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--accounts", default="EU:200,shared:100", help="region:count,... (shared = no region)")
+    parser.add_argument("--unleveled", type=float, default=0.0, help="share of unleveled accounts")
+    parser.add_argument("--devices", default="EU:iv:30,EU:level:3", help="region:purpose:count,...")
+    parser.add_argument("--encounter-rate", type=float, default=1200, help="encounters per hour of synthetic devices")
+    parser.add_argument("--hours-to-burn", type=float, default=8, help="mean hours until a synthetic device hits a maintenance screen")
+    parser.add_argument("--recorded", type=int, default=0, help="replay pool and demand of the last N days of the database instead")
+    parser.add_argument("--sweep", nargs="*", default=[], help="policy=value1,value2 ... (cartesian product)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args(argv)
+
+    if args.recorded:
+        accounts, devices = load_recorded(args.recorded)
+    else:
+        accounts = _parse_accounts(args.accounts, args.unleveled)
+        devices = _parse_devices(args.devices, args.encounter_rate, args.hours_to_burn)
+
+    names, values = [], []
+    for sweep in args.sweep:
+        name, options = sweep.split("=")
+        if name not in Policy.__dataclass_fields__:
+            parser.error(f"unknown policy {name}, use one of {', '.join(Policy.__dataclass_fields__)}")
+        names.append(name)
+        values.append([int(option) for option in options.split(",")])
+    policies = [Policy(**dict(zip(names, combination))) for combination in itertools.product(*values)]
+
+    jobs = [(policy, accounts, devices, args.days, args.seed) for policy in policies]
+    with multiprocessing.Pool(min(args.processes, len(jobs))) as pool:
+        for result in pool.imap(_simulate, jobs):
+            sys.stdout.buffer.write(orjson.dumps(result) + b"\n")
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
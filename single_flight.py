@@ -0,0 +1,78 @@
+import threading
+import time
+from typing import Any, Callable, Hashable, Optional
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution.
+
+    Callers arriving while a computation for their key is in flight wait for it and share its result.
+    Results are additionally kept for `ttl_seconds`, so near-concurrent callers are served without a new call. At most
+    `max_entries` results are kept (0 = unbounded), the oldest are dropped first, and only those `cache_if` accepts.
+    """
+
+    def __init__(self, ttl_seconds: float = 0.0, max_entries: int = 0, cache_if: Optional[Callable[[Any], bool]] = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.cache_if = cache_if
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call] = {}
+        self._results: dict[Hashable, tuple[float, Any]] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            cached = self._results.get(key)
+            if cached and cached[0] > time.monotonic():
+                return cached[1]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None and self.ttl_seconds > 0 and (self.cache_if is None or self.cache_if(call.value)):
+                    self._store(key, call.value)
+            call.done.set()
+        return call.value
+
+    def forget(self, key: Hashable):
+        with self._lock:
+            self._results.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def _store(self, key: Hashable, value: Any):
+        now = time.monotonic()
+        self._results.pop(key, None)
+        self._results[key] = (now + self.ttl_seconds, value)
+        # insertion ordered and with a fixed ttl, so expired and surplus entries are at the front
+        surplus = len(self._results) - self.max_entries if self.max_entries > 0 else 0
+        while self._results:
+            oldest = next(iter(self._results))
+            if self._results[oldest][0] > now and surplus <= 0:
+                break
+            del self._results[oldest]
+            surplus -= 1
@@ -0,0 +1,59 @@
+import mmap
+import os
+import struct
+from typing import Optional
+
+from loguru import logger
+
+# file layout: header, then sections of (name, length, payload)
+MAGIC = b"PASN"
+VERSION = 1
+_HEADER = struct.Struct("<4sH")
+_SECTION = struct.Struct("<32sQ")
+
+
+def write_snapshot(path: str, sections: dict[str, bytes]):
+    """Writes `sections` atomically, readers never see a partially written snapshot."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION))
+        for name, payload in sections.items():
+            if len(name.encode()) > 32:
+                raise ValueError(f"section name {name} exceeds 32 bytes")
+            f.write(_SECTION.pack(name.encode(), len(payload)))
+            f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str) -> Optional[dict[str, bytes]]:
+    if not os.path.isfile(path) or os.path.getsize(path) < _HEADER.size:
+        return None
+    sections = {}
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, version = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            logger.warning(f"Ignoring snapshot {path} of unsupported format {magic!r} v{version}")
+            return None
+        offset = _HEADER.size
+        while offset < len(data):
+            name, length = _SECTION.unpack_from(data, offset)
+            offset += _SECTION.size
+            if offset + length > len(data):
+                logger.warning(f"Ignoring truncated snapshot {path}")
+                return None
+            sections[name.rstrip(b"\0").decode()] = data[offset:offset + length]
+            offset += length
+    return sections
+
+
+def pack_strings(values: list[Optional[str]]) -> bytes:
+    # None is stored as an empty string
+    return b"\0".join((value or "").encode() for value in values)
+
+
+def unpack_strings(payload: bytes, count: int) -> list[Optional[str]]:
+    if not count:
+        return []
+    return [value.decode() or None for value in payload.split(b"\0")]
@@ -0,0 +1,16 @@
+CREATE TABLE accounts_history_hourly (
+                          hour datetime not null,
+                          region varchar(10) not null default '',
+                          purpose varchar(20) not null default '',
+                          reason varchar(50) not null default '',
+                          events int not null default 0,
+                          encounters bigint not null default 0,
+                          PRIMARY KEY (hour, region, purpose, reason));
+
+CREATE TABLE rollup_state (
+                          name varchar(50) not null,
+                          watermark datetime,
+                          PRIMARY KEY (name));
+
+ALTER TABLE accounts_history
+    ADD INDEX returned (returned);
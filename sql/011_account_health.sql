@@ -0,0 +1,10 @@
+ALTER TABLE accounts
+    ADD health SMALLINT NOT NULL DEFAULT 100,
+    ADD INDEX health (health);
+
+UPDATE accounts a JOIN
+       (SELECT username, SUM(reason IN ('maintenance', 'nologin')) failures, COUNT(*) sessions
+          FROM accounts_history
+         WHERE returned IS NOT NULL
+      GROUP BY username) ah ON a.username = ah.username
+   SET a.health = ROUND(100 * (1 - ah.failures / ah.sessions));
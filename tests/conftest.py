@@ -0,0 +1,14 @@
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# config.py reads config/config.ini relative to the working directory at import time
+if not os.path.isfile(os.path.join("config", "config.ini")):
+    _workdir = tempfile.mkdtemp(prefix="pogo-account-server-tests-")
+    os.makedirs(os.path.join(_workdir, "config"))
+    shutil.copy(os.path.join(ROOT, "config", "config.ini.example"), os.path.join(_workdir, "config", "config.ini"))
+    os.chdir(_workdir)
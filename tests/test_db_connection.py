@@ -0,0 +1,89 @@
+import types
+
+import mysql.connector
+import pytest
+
+from db_connection import CircuitBreaker, DatabaseUnavailable, DbConnection, DeadlineExceeded, _Cursor, clear_deadline, set_deadline
+
+
+class _FakeCursor:
+    def __init__(self, error=None):
+        self.error = error
+        self.executed = []
+
+    def execute(self, operation, params=None):
+        if self.error:
+            raise self.error
+        self.executed.append(operation)
+
+
+def _cursor(error=None, breaker=None):
+    connection = types.SimpleNamespace(breaker=breaker or CircuitBreaker(3, 10), replica=None)
+    return _Cursor(_FakeCursor(error), connection), connection.breaker
+
+
+@pytest.fixture
+def injected_latency():
+    previous = DbConnection.injected_latency
+    yield
+    DbConnection.injected_latency = previous
+    clear_deadline()
+
+
+def test_statement_timeout_raises_deadline_exceeded():
+    cursor, breaker = _cursor(mysql.connector.errors.DatabaseError(msg="Query execution was interrupted", errno=3024))
+    with pytest.raises(DeadlineExceeded):
+        cursor.execute("SELECT 1")
+    assert len(breaker._failures) == 1
+
+
+def test_lost_connection_raises_database_unavailable():
+    cursor, _ = _cursor(mysql.connector.errors.OperationalError(msg="Lost connection", errno=2013))
+    with pytest.raises(DatabaseUnavailable):
+        cursor.execute("SELECT 1")
+
+
+def test_query_errors_are_not_converted():
+    cursor, breaker = _cursor(mysql.connector.errors.ProgrammingError(msg="syntax", errno=1064))
+    with pytest.raises(mysql.connector.errors.ProgrammingError):
+        cursor.execute("SELEC 1")
+    assert not breaker._failures
+
+
+def test_injected_latency_beyond_deadline_times_out(injected_latency):
+    DbConnection.injected_latency = (0.05, 0)
+    set_deadline(0.01)
+    cursor, breaker = _cursor()
+    with pytest.raises(DeadlineExceeded):
+        cursor.execute("SELECT 1")
+    assert len(breaker._failures) == 1
+
+
+def test_injected_latency_within_deadline_succeeds(injected_latency):
+    DbConnection.injected_latency = (0.01, 0)
+    set_deadline(1)
+    cursor, _ = _cursor()
+    cursor.execute("SELECT 1")
+    assert cursor._cursor.executed == ["SELECT 1"]
+
+
+def test_timeouts_between_successes_open_the_circuit():
+    breaker = CircuitBreaker(3, 10)
+    timing_out, _ = _cursor(mysql.connector.errors.DatabaseError(msg="timeout", errno=3024), breaker)
+    healthy, _ = _cursor(breaker=breaker)
+    for _ in range(3):
+        healthy.execute("SELECT 1")
+        with pytest.raises(DeadlineExceeded):
+            timing_out.execute("SELECT 1")
+    assert breaker.state == "open"
+    assert breaker.retry_after() > 0
+
+
+def test_successful_trial_closes_the_circuit():
+    breaker = CircuitBreaker(1, 0)
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.retry_after() is None
+    assert breaker.state == "half-open"
+    breaker.record_success()
+    assert breaker.state == "closed"
@@ -0,0 +1,20 @@
+import pytest
+
+import export
+from db_connection import DatabaseUnavailable
+
+
+def test_started_keeps_every_row():
+    assert list(export.started(iter([(1,), (2,), (3,)]))) == [(1,), (2,), (3,)]
+    assert list(export.started(iter([]))) == []
+
+
+def test_unavailable_database_surfaces_before_streaming(monkeypatch):
+    def unavailable():
+        raise DatabaseUnavailable("database circuit is open", 7)
+
+    monkeypatch.setattr(export, "Db", unavailable)
+    rows = export.export_rows("accounts")
+    with pytest.raises(DatabaseUnavailable) as raised:
+        export.started(rows)
+    assert raised.value.retry_after == 7
@@ -0,0 +1,33 @@
+from forecast import EligibilityTimeline
+
+
+def _timeline() -> EligibilityTimeline:
+    timeline = EligibilityTimeline(cooldown_seconds=3600, short_cooldown_seconds=60, account_max_logins_hour=2)
+    timeline.load([("user1", "EU", 30, "device1", 1000, 0, False), ("user2", "EU", 30, "device2", 1000, 0, False)], {})
+    return timeline
+
+
+def test_catch_up_releases_holders_of_returned_accounts(monkeypatch):
+    timeline = _timeline()
+    assert timeline.holders() == {"device1": "user1", "device2": "user2"}
+    # user1 was returned after the snapshot
+    monkeypatch.setattr(EligibilityTimeline, "_query", staticmethod(lambda *args: ([("user1", "EU", 30, None, 1000, 2000, True)], {})))
+    assert timeline.catch_up(last_updated=1500, history_id=10) == 1
+    assert timeline.holders() == {"device2": "user2"}
+
+
+def test_snapshot_round_trip_keeps_holders():
+    timeline = _timeline()
+    restored = EligibilityTimeline(cooldown_seconds=3600, short_cooldown_seconds=60, account_max_logins_hour=2)
+    restored.restore_state(timeline.export_state())
+    assert restored.holders() == timeline.holders()
+
+
+def test_reusing_a_held_account_is_no_login():
+    timeline = EligibilityTimeline(cooldown_seconds=3600, short_cooldown_seconds=60, account_max_logins_hour=1)
+    timeline.load([("user1", "EU", 10, None, 0, 0, False)], {})
+    timeline.claimed("user1", "device1", now=1000)
+    timeline.claimed("user1", "device1", now=1100)
+    timeline.returned("device1", burned=False, now=1200)
+    # a single login stays within the limit, the account is eligible right away
+    assert timeline.histogram(bucket_seconds=600, horizon_seconds=3600, now=1200)["EU"]["level"]["available"] == 1
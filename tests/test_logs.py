@@ -0,0 +1,80 @@
+import logging
+import sys
+import time
+
+from loguru import logger
+
+import logs
+from config import Config
+
+_QUERY = ("INSERT INTO accounts_history (device, username, acquired, reason, purpose) "
+          "VALUES ('bench', 'user', '2026-10-19 12:00:00', 'limit', 'iv')")
+
+
+class _NullSink:
+    def write(self, message):
+        pass
+
+    def flush(self):
+        pass
+
+
+def test_account_response_password_is_redacted():
+    record = {"message": str({"username": "user", "password": "secret", "level": 30})}
+    logs.redact_credentials(record)
+    assert "secret" not in record["message"]
+    assert "'username': 'user'" in record["message"]
+
+
+def _setup_synchronous_logger():
+    """The logger before request-path logging was made asynchronous: a colorized stdout sink written by the calling thread."""
+    log_format_console = ("[<cyan>{time:MM-DD HH:mm:ss.SS}</cyan>] [<cyan>{module: >12}:{line: <4}</cyan>] "
+                          "[<cyan>{extra[name]: >12}</cyan>] [<lvl>{level: >1.1}</lvl>] <level>{message}</level>")
+    logger.remove()
+    logger.add(sys.stdout, format=log_format_console, level=Config.loglevel, colorize=True)
+    logger.configure(extra={"name": ""})
+
+
+def _get_account_before(device_logger, data: dict, location: str):
+    """The log calls of one get_account before: eager f-strings and the full response dict at INFO."""
+    device_logger.debug(f"get_account: purpose={'iv'}, region={'EU'}, reason={'limit'}, location={location}")
+    device_logger.info(f"History: {_QUERY}")
+    logger.debug(data)
+    device_logger.info("get_account: " + str(data))
+    logger.debug(f"responding with {200}, data: {data}")
+
+
+def _get_account_after(device_logger, data: dict, location: str):
+    device_logger.debug("get_account: purpose={}, region={}, reason={}, location={}", "iv", "EU", "limit", location)
+    device_logger.debug("History: {}", _QUERY)
+    logger.debug(data)
+    device_logger.info("get_account: {} (level {}, remaining encounters {})", data["username"], data["level"], data["remaining_encounters"])
+    logger.debug("responding with {}, data: {}", 200, data)
+
+
+def _seconds_per_request(log_calls, requests: int = 2000) -> float:
+    device_logger = logger.bind(name="bench")
+    data = {"username": "user", "password": "secret", "level": 30, "remaining_encounters": 4500, "is_burnt": 0}
+    location = '{"lat": 52.52, "lng": 13.405}'
+    started = time.perf_counter()
+    for _ in range(requests):
+        log_calls(device_logger, data, location)
+    elapsed = time.perf_counter() - started
+    logger.complete()
+    return elapsed / requests
+
+
+def test_benchmark_get_account_logging(monkeypatch, record_property):
+    """Benchmark: time a request thread spends logging one get_account, before and after, both writing to a null sink."""
+    monkeypatch.setattr(sys, "stdout", _NullSink())
+    monkeypatch.setattr(Config, "loglevel", logging.INFO)
+    try:
+        _setup_synchronous_logger()
+        before = _seconds_per_request(_get_account_before)
+        logs.setup_logger()
+        after = _seconds_per_request(_get_account_after)
+    finally:
+        logger.remove()
+    record_property("get_account_logging_us_before", round(before * 1e6, 1))
+    record_property("get_account_logging_us_after", round(after * 1e6, 1))
+    assert after < before, f"{after * 1e6:.1f}us per get_account after, {before * 1e6:.1f}us before"
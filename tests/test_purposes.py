@@ -0,0 +1,17 @@
+import pytest
+
+from purposes import PURPOSES, purpose_accepts_level, purpose_level_query
+
+
+def test_level_queries():
+    assert purpose_level_query("iv") == " (level >= 30)"
+    assert purpose_level_query("mon_raid") == " (level >= 8)"
+    assert purpose_level_query("level") == " (level < 30)"
+    assert purpose_level_query("unknown") == " (1=1)"
+
+
+@pytest.mark.parametrize("purpose", PURPOSES + ("unknown",))
+def test_in_memory_check_matches_query(purpose):
+    query = purpose_level_query(purpose).strip(" ()").replace("1=1", "True").replace(" AND ", " and ")
+    for level in range(0, 50):
+        assert purpose_accepts_level(purpose, level) == eval(query, {"level": level})
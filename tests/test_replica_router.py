@@ -0,0 +1,130 @@
+import mysql.connector
+import pytest
+
+import db_connection
+from db_connection import DbConnection, ReplicaRouter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(db_connection.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _router(replicas: int = 2) -> ReplicaRouter:
+    router = ReplicaRouter([(f"replica{i}", 3306) for i in range(replicas)], max_lag_seconds=5, read_your_writes_seconds=10,
+                           lag_check_seconds=2, failure_threshold=1, reset_seconds=10)
+    for replica in router.replicas:
+        router.lag_checked(replica, 0.0)
+    return router
+
+
+def test_without_replicas_reads_from_primary(clock):
+    assert ReplicaRouter([], 5, 10).choose("device") is None
+
+
+def test_unchecked_replica_is_tried(clock):
+    router = ReplicaRouter([("replica0", 3306)], 5, 10)
+    assert router.choose(None) is router.replicas[0]
+    assert router.needs_lag_check(router.replicas[0])
+
+
+def test_replicas_are_used_round_robin(clock):
+    router = _router()
+    assert {router.choose(None).host for _ in range(4)} == {"replica0", "replica1"}
+
+
+def test_device_reads_its_own_writes_from_primary(clock):
+    router = _router()
+    router.wrote("device")
+    assert router.choose("device") is None
+    assert router.choose("other") is not None
+    clock[0] += 10
+    assert router.choose("device") is not None
+
+
+def test_lagging_replica_is_skipped_until_rechecked(clock):
+    router = _router(1)
+    replica = router.replicas[0]
+    router.lag_checked(replica, 6.0)
+    assert router.choose(None) is None
+    clock[0] += 2
+    # due for a re-check, the connection measures the lag again before using it
+    assert router.choose(None) is replica
+    router.lag_checked(replica, 1.0)
+    assert router.choose(None) is replica
+
+
+def test_replica_with_open_circuit_is_skipped(clock):
+    router = _router()
+    router.replicas[0].breaker.record_failure()
+    assert {router.choose(None).host for _ in range(4)} == {"replica1"}
+
+
+class _StatusCursor:
+    def __init__(self, rows, legacy=False):
+        self.rows = rows
+        self.legacy = legacy
+        self.executed = []
+
+    def execute(self, operation):
+        self.executed.append(operation)
+        if self.legacy and operation == "SHOW REPLICA STATUS":
+            raise mysql.connector.errors.ProgrammingError(msg="syntax error", errno=1064)
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class _StatusConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self, dictionary=False):
+        return self._cursor
+
+
+@pytest.mark.parametrize("rows, stand_in, lag", [
+    ([{"Seconds_Behind_Source": 3}], False, 3.0),
+    ([{"Seconds_Behind_Source": None}], False, None),
+    ([], False, None),
+    ([], True, 0.0),
+])
+def test_replication_lag(rows, stand_in, lag):
+    assert DbConnection._replication_lag(_StatusConnection(_StatusCursor(rows)), stand_in) == lag
+
+
+def test_replication_lag_of_legacy_servers():
+    cursor = _StatusCursor([{"Seconds_Behind_Master": 2}], legacy=True)
+    assert DbConnection._replication_lag(_StatusConnection(cursor)) == 2.0
+    assert cursor.executed == ["SHOW REPLICA STATUS", "SHOW SLAVE STATUS"]
+
+
+class _ClosableConnection(_StatusConnection):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_failed_lag_check_closes_the_replica_connection(monkeypatch, clock):
+    denied = mysql.connector.errors.ProgrammingError(msg="Access denied; you need the REPLICATION CLIENT privilege", errno=1227)
+
+    class _DeniedCursor(_StatusCursor):
+        def execute(self, operation):
+            raise denied
+
+    conn = _ClosableConnection(_DeniedCursor([]))
+    router = ReplicaRouter([("replica0", 3306)], 5, 10)
+    monkeypatch.setattr(DbConnection, "router", router)
+    monkeypatch.setattr(db_connection.mysql.connector, "connect", lambda **config: conn)
+
+    assert DbConnection.__new__(DbConnection)._connect_replica(None) is None
+    assert conn.closed
+    assert router.replicas[0].lag is None
+    # skipped until the lag is due for a re-check
+    assert router.choose(None) is None
@@ -0,0 +1,53 @@
+from flask import Flask
+
+import responses
+from responses import ResourceVersions, encode, not_modified
+
+
+def _app(versions: ResourceVersions) -> Flask:
+    app = Flask(__name__)
+
+    @app.route("/stats")
+    def stats():
+        etag = versions.pool_etag()
+        unchanged = not_modified(etag, {})
+        if unchanged:
+            return unchanged
+        return encode({"status": "ok"}, 200, {}, etag=etag)
+
+    return app
+
+
+def test_etag_round_trip_returns_304():
+    client = _app(ResourceVersions()).test_client()
+    first = client.get("/stats")
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+
+    second = client.get("/stats", headers={"If-None-Match": etag})
+    assert second.status_code == 304
+    assert second.headers["ETag"] == etag
+    assert second.data == b""
+
+
+def test_changed_version_returns_200():
+    versions = ResourceVersions()
+    client = _app(versions).test_client()
+    etag = client.get("/stats").headers["ETag"]
+    versions.changed("device")
+
+    response = client.get("/stats", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_changed_within_tracks_pool_and_device(monkeypatch):
+    versions = ResourceVersions()
+    assert not versions.changed_within(5)
+    monkeypatch.setattr(responses.time, "monotonic", lambda: 100.0)
+    versions.changed("device")
+    assert versions.changed_within(5)
+    assert versions.changed_within(5, "device")
+    assert not versions.changed_within(5, "other")
+    monkeypatch.setattr(responses.time, "monotonic", lambda: 106.0)
+    assert not versions.changed_within(5, "device")
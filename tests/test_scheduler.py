@@ -0,0 +1,103 @@
+import collections
+import random
+
+import pytest
+
+import scheduler
+from scheduler import AllocationScheduler
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(scheduler.time, "monotonic", clock)
+    return clock
+
+
+def _simulate(clock, devices: list[tuple[str, str]], seconds: int, supply_interval: int, session_seconds: int, use_scheduler: bool = True):
+    """Devices poll for accounts of a scarce pool that gains one account every `supply_interval` seconds."""
+    allocation = AllocationScheduler({"iv": 3, "quest": 1}, {}, window=2)
+    available = 0
+    next_poll = {device: 0 for (device, _) in devices}
+    waiting_since = dict(next_poll)
+    holding = {}
+    grants = collections.Counter()
+    waits = collections.defaultdict(list)
+    empty_searches = 0
+    shuffled = random.Random(1)
+    for second in range(seconds):
+        clock.now = float(second)
+        if second % supply_interval == 0:
+            available += 1
+        for (device, purpose) in shuffled.sample(devices, len(devices)):
+            if device in holding:
+                if holding[device] > second:
+                    continue
+                del holding[device]
+                allocation.released(device)
+                waiting_since[device] = next_poll[device] = second
+            if next_poll[device] > second:
+                continue
+            queued = allocation.admit(device, purpose, "EU") if use_scheduler else None
+            if queued:
+                next_poll[device] = second + queued.retry_after
+                continue
+            if available:
+                available -= 1
+                allocation.granted(device, purpose, "EU")
+                grants[purpose] += 1
+                waits[purpose].append(second - waiting_since[device])
+                holding[device] = second + session_seconds
+            else:
+                empty_searches += 1
+                allocation.denied(device, purpose, "EU")
+                next_poll[device] = second + allocation.retry_min
+    return grants, waits, empty_searches
+
+
+DEVICES = [(f"iv-{i}", "iv") for i in range(10)] + [(f"quest-{i}", "quest") for i in range(10)]
+
+
+def test_grants_follow_purpose_weights(clock):
+    grants, _, _ = _simulate(clock, DEVICES, seconds=6 * 3600, supply_interval=60, session_seconds=300)
+    assert 2.7 <= grants["iv"] / grants["quest"] <= 3.3
+
+
+def test_waits_are_bounded(clock):
+    _, waits, _ = _simulate(clock, DEVICES, seconds=6 * 3600, supply_interval=60, session_seconds=300)
+    # every purpose keeps being served, the lighter one just waits longer
+    assert max(waits["iv"]) < 1200
+    assert max(waits["quest"]) < 3600
+
+
+def test_queueing_avoids_wasted_searches(clock):
+    _, _, with_scheduler = _simulate(clock, DEVICES, seconds=3600, supply_interval=60, session_seconds=300)
+    _, _, without_scheduler = _simulate(clock, DEVICES, seconds=3600, supply_interval=60, session_seconds=300, use_scheduler=False)
+    assert with_scheduler * 5 < without_scheduler
+
+
+def test_level_devices_do_not_queue_behind_other_pools(clock):
+    allocation = AllocationScheduler({}, {}, window=1)
+    for i in range(3):
+        allocation.denied(f"iv-{i}", "iv", "EU")
+    clock.now = 10.0
+    assert allocation.admit("iv-new", "iv", "EU") is not None
+    assert allocation.admit("level-0", "level", "EU") is None
+    assert allocation.admit("iv-other-region", "iv", "US") is None
+
+
+def test_region_quota(clock):
+    allocation = AllocationScheduler({}, {"EU": 1})
+    allocation.granted("a", "iv", "EU")
+    queued = allocation.admit("b", "iv", "EU")
+    assert queued is not None and queued.reason == "quota"
+    allocation.released("a")
+    assert allocation.admit("b", "iv", "EU") is None